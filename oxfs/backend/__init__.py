@@ -0,0 +1,14 @@
+name = "backend"
+
+# A backend makes connections and sftp-like channels over them:
+#   connect() -> client, client.exec_command(command) and client.close()
+#   open(client) -> channel, a paramiko SFTPClient or an object with the
+#       same lstat, stat, listdir_attr, open, get, chmod, chown, mkdir,
+#       rmdir, unlink, rename, posix_rename, symlink, readlink, truncate,
+#       utime and close,
+#       its files read ranges with readv and write ranges with seek + write
+#   active(client), alive(channel) and keepalive(client, seconds)
+# A channel may count the requests it sent in `requests`, for the metrics,
+# and may copy between its open files on the server with
+# copy_data(src, dst, offset, length, dst_offset), raising IOError when the
+# server can not.
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+
+import io
+import os
+import paramiko
+import select
+import shutil
+import signal
+import subprocess
+import threading
+import time
+
+
+class Link:
+    '''
+    Simulated network, every request waits `latency_ms` and the bytes moved
+    share `bandwidth_mbps` MB/s, 0 for unlimited.
+    '''
+
+    def __init__(self, latency_ms=0, bandwidth_mbps=0):
+        self.latency = latency_ms / 1000.0
+        self.bandwidth = bandwidth_mbps * 2**20
+        self.lock = threading.Lock()
+        self.free = 0  # the link is busy until this time
+        self.stats = dict(requests=0, bytes=0)
+
+    def delay(self, nbytes=0, roundtrip=True):
+        wait = self.latency if roundtrip else 0
+        with self.lock:
+            self.stats['requests'] += roundtrip
+            self.stats['bytes'] += nbytes
+            if self.bandwidth and nbytes:
+                now = time.time()
+                self.free = max(self.free, now) + nbytes / self.bandwidth
+                wait += self.free - now
+        if wait > 0:
+            time.sleep(wait)
+
+
+class LocalFile(io.FileIO):
+    def __init__(self, channel, path, mode):
+        self.channel = channel
+        self.pipelined = False
+        mode = mode.replace('b', '')
+        super().__init__(path, mode if mode != 'w' else 'w+')
+        self.channel.delay()
+
+    def set_pipelined(self, pipelined=True):
+        self.pipelined = pipelined
+
+    def prefetch(self, file_size=None):
+        pass
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.channel.delay(len(data))
+        return data
+
+    def readv(self, chunks):
+        # one round trip for the whole batch, like a pipelined readv
+        self.channel.delay()
+        for offset, size in chunks:
+            self.seek(offset)
+            data = super().read(size)
+            self.channel.delay(len(data), False)
+            yield data
+
+    def write(self, data):
+        self.channel.delay(len(data), not self.pipelined)
+        return super().write(data)
+
+    def stat(self):
+        self.channel.delay()
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.fileno()))
+
+    def check(self, hash_algorithm, offset=0, length=0, block_size=0):
+        raise IOError('check-file is not supported')
+
+
+class LocalChannel:
+    '''
+    The sftp channel calls served from the local file system through `link`,
+    `requests` counts the round trips made on it.
+    '''
+
+    def __init__(self, link):
+        self.link = link
+        self.closed = False
+        self.requests = 0
+
+    def delay(self, nbytes=0, roundtrip=True):
+        self.requests += roundtrip
+        self.link.delay(nbytes, roundtrip)
+
+    def lstat(self, path):
+        self.delay()
+        return paramiko.SFTPAttributes.from_stat(os.lstat(path))
+
+    def stat(self, path):
+        self.delay()
+        return paramiko.SFTPAttributes.from_stat(os.stat(path))
+
+    def listdir(self, path):
+        self.delay()
+        return os.listdir(path)
+
+    def listdir_attr(self, path):
+        self.delay()
+        return [paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)), name)
+                for name in os.listdir(path)]
+
+    def open(self, path, mode='r', bufsize=-1):
+        return LocalFile(self, path, mode)
+
+    def get(self, remotepath, localpath, callback=None):
+        self.delay(os.lstat(remotepath).st_size)
+        shutil.copyfile(remotepath, localpath)
+
+    def copy_data(self, src, dst, offset=0, length=0, dst_offset=0):
+        # a single request, the data stays on the server
+        self.delay()
+        end = offset + length if length else os.fstat(src.fileno()).st_size
+        while offset < end:
+            data = os.pread(src.fileno(), min(end - offset, 2**20), offset)
+            if not data:
+                break
+            os.pwrite(dst.fileno(), data, dst_offset)
+            offset += len(data)
+            dst_offset += len(data)
+
+    def chmod(self, path, mode):
+        self.delay()
+        os.chmod(path, mode)
+
+    def chown(self, path, uid, gid):
+        self.delay()
+        os.chown(path, uid, gid)
+
+    def mkdir(self, path, mode=0o777):
+        self.delay()
+        os.mkdir(path, mode)
+
+    def rmdir(self, path):
+        self.delay()
+        os.rmdir(path)
+
+    def unlink(self, path):
+        self.delay()
+        os.unlink(path)
+
+    remove = unlink
+
+    def rename(self, oldpath, newpath):
+        self.delay()
+        if os.path.exists(newpath):
+            raise IOError('rename {} failed, {} exists'.format(oldpath, newpath))
+        os.rename(oldpath, newpath)
+
+    def posix_rename(self, oldpath, newpath):
+        self.delay()
+        os.rename(oldpath, newpath)
+
+    def symlink(self, source, dest):
+        self.delay()
+        os.symlink(source, dest)
+
+    def readlink(self, path):
+        self.delay()
+        return os.readlink(path)
+
+    def truncate(self, path, size):
+        self.delay()
+        os.truncate(path, size)
+
+    def utime(self, path, times):
+        self.delay()
+        os.utime(path, times)
+
+    def close(self):
+        self.closed = True
+
+
+class LocalProcess:
+    def __init__(self, process):
+        self.process = process
+        self.closed = False
+
+    def recv_ready(self):
+        return bool(select.select([self.process.stdout], [], [], 0)[0])
+
+    def recv_exit_status(self):
+        return self.process.wait()
+
+    def close(self):
+        self.closed = True
+        if self.process.poll() is None:
+            # the shell and everything it started
+            os.killpg(self.process.pid, signal.SIGKILL)
+
+
+class LocalStream:
+    def __init__(self, channel, stream):
+        self.channel = channel
+        self.stream = stream
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def write(self, data):
+        self.stream.write(data)
+
+    def __iter__(self):
+        for line in self.stream:
+            yield line.decode('utf-8')
+
+    def close(self):
+        self.stream.close()
+
+
+class LocalClient:
+    def __init__(self, link):
+        self.link = link
+        self.closed = False
+
+    def exec_command(self, command):
+        '''
+        Runs `command` on this host, the streams behave like paramiko's.
+        '''
+        self.link.delay()
+        process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   start_new_session=True)
+        channel = LocalProcess(process)
+        return (LocalStream(channel, process.stdin), LocalStream(channel, process.stdout),
+                LocalStream(channel, process.stderr))
+
+    def close(self):
+        self.closed = True
+
+
+class LocalBackend:
+    '''
+    Serves the local file system as if it were remote, with injected
+    latency and bandwidth, so the caches, read-ahead and write-back can be
+    exercised without a network.
+    '''
+
+    def __init__(self, latency_ms=0, bandwidth_mbps=0):
+        self.link = Link(latency_ms, bandwidth_mbps)
+
+    def connect(self):
+        self.link.delay()
+        return LocalClient(self.link)
+
+    def open(self, client):
+        self.link.delay()
+        return LocalChannel(self.link)
+
+    @staticmethod
+    def active(client):
+        return not client.closed
+
+    @staticmethod
+    def alive(channel):
+        return not channel.closed
+
+    @staticmethod
+    def keepalive(client, seconds):
+        pass
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+import paramiko
+import struct
+
+from paramiko.message import Message
+from paramiko.sftp import CMD_EXTENDED, CMD_INIT, CMD_VERSION, SFTPError, _VERSION, int64
+
+
+class Channel(paramiko.SFTPClient):
+    '''
+    Counts the requests sent on the channel, its files' included, and keeps
+    the extensions the server announced.
+    '''
+
+    requests = 0
+    extensions = dict()
+
+    def _async_request(self, fileobj, t, *args):
+        self.requests += 1
+        return super()._async_request(fileobj, t, *args)
+
+    def _send_version(self):
+        # as paramiko does, but the extension pairs are kept
+        m = Message()
+        m.add_int(_VERSION)
+        self._send_packet(CMD_INIT, m)
+        t, data = self._read_packet()
+        if t != CMD_VERSION:
+            raise SFTPError('Incompatible sftp protocol')
+        version = struct.unpack('>I', data[:4])[0]
+        m, extensions = Message(data[4:]), dict()
+        while m.get_remainder():
+            name = m.get_text()
+            extensions[name] = m.get_binary()
+        self.extensions = extensions
+        return version
+
+    def posix_rename(self, oldpath, newpath):
+        # replaces `newpath` when the server can, a plain rename otherwise
+        if 'posix-rename@openssh.com' not in self.extensions:
+            return self.rename(oldpath, newpath)
+        return super().posix_rename(oldpath, newpath)
+
+    def copy_data(self, src, dst, offset=0, length=0, dst_offset=0):
+        '''
+        Copies `length` bytes of the open file `src` from `offset` to `dst`
+        at `dst_offset` on the server, 0 copies up to the end of `src`.
+        '''
+        if 'copy-data' not in self.extensions:
+            raise IOError('copy-data is not supported')
+        self._request(CMD_EXTENDED, 'copy-data', src.handle, int64(offset),
+                      int64(length), dst.handle, int64(dst_offset))
+
+
+class SFTPBackend:
+    '''
+    Paramiko SFTPClient channels over the SSHClients made by `connect`.
+    '''
+
+    def __init__(self, connect):
+        self.connect = connect
+
+    @staticmethod
+    def open(client):
+        return Channel.from_transport(client.get_transport())
+
+    @staticmethod
+    def active(client):
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    @staticmethod
+    def alive(sftp):
+        return not sftp.get_channel().closed
+
+    @staticmethod
+    def keepalive(client, seconds):
+        client.get_transport().set_keepalive(seconds)
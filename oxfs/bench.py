@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import random
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+from oxfs.backend.local import LocalBackend
+from oxfs.oxfs import Oxfs
+
+WORKLOADS = ['metadata', 'walk', 'seqread', 'randread', 'smallwrite', 'copy']
+
+
+class Bench:
+    '''
+    Runs workloads through the Oxfs operations of `fs`, the same calls fuse
+    makes, under the mount path `root`. Each one reports ops/s, latency
+    percentiles and the bytes moved, on the wire too when the backend
+    counts them.
+    '''
+
+    def __init__(self, fs, root, scale=1):
+        self.fs = fs
+        self.root = root
+        self.scale = scale
+        self.random = random.Random(0)
+        self.samples = []
+        self.bytes = 0
+
+    def call(self, op, *args):
+        started = time.perf_counter()
+        try:
+            return self.fs(op, *args)
+        finally:
+            self.samples.append(time.perf_counter() - started)
+
+    def path(self, *names):
+        return os.path.join(self.root, *names)
+
+    def fixture(self, path, size):
+        # written behind the cache, so the workload starts cold
+        sftp = self.fs.channel()
+        try:
+            with sftp.open(self.fs.remotepath(path), 'wb') as outfile:
+                outfile.set_pipelined(True)
+                for offset in range(0, size, 2**20):
+                    outfile.write(os.urandom(min(2**20, size - offset)))
+        finally:
+            self.fs.release_channel()
+
+    def directory(self, path):
+        sftp = self.fs.channel()
+        try:
+            sftp.mkdir(self.fs.remotepath(path))
+        finally:
+            self.fs.release_channel()
+
+    def drain(self):
+        # a flush takes the journal's flushing lock, so one already under
+        # way is waited for before what is left is written
+        sftp = self.fs.channel()
+        try:
+            for path in self.fs.writeback.below(self.fs.remotepath('/')):
+                self.fs._flush(path, sftp)
+        finally:
+            self.fs.release_channel()
+
+    def wire(self):
+        link = getattr(self.fs.pool.backend, 'link', None)
+        return dict(link.stats) if link is not None else None
+
+    def run(self, name):
+        self.directory(self.path(name))
+        getattr(self, 'prepare_' + name, lambda: None)()
+        self.samples, self.bytes = [], 0
+        wire = self.wire()
+        started = time.perf_counter()
+        getattr(self, name)()
+        self.drain()
+        seconds = time.perf_counter() - started
+        return self.report(seconds, wire)
+
+    def report(self, seconds, wire):
+        samples = sorted(self.samples)
+
+        def percentile(q):
+            if not samples:
+                return None
+            return samples[int(q * (len(samples) - 1))] * 1000
+
+        result = dict(ops=len(samples), seconds=seconds,
+                      ops_per_sec=len(samples) / seconds if seconds else None,
+                      p50_ms=percentile(0.5), p99_ms=percentile(0.99),
+                      bytes=self.bytes)
+        after = self.wire()
+        if wire is not None:
+            result.update(wire_requests=after['requests'] - wire['requests'],
+                          wire_bytes=after['bytes'] - wire['bytes'])
+        return result
+
+    def prepare_metadata(self):
+        for i in range(100 * self.scale):
+            self.fixture(self.path('metadata', 'f{}'.format(i)), 64)
+
+    def metadata(self):
+        # a cold pass, then warm passes as ls -l or make would do
+        for _ in range(3):
+            self.call('readdir', self.path('metadata'), None)
+            for i in range(100 * self.scale):
+                self.call('getattr', self.path('metadata', 'f{}'.format(i)), None)
+
+    def prepare_walk(self):
+        def tree(path, depth):
+            for i in range(3):
+                self.fixture(os.path.join(path, 'f{}'.format(i)), 256)
+            if depth:
+                for i in range(4):
+                    child = os.path.join(path, 'd{}'.format(i))
+                    self.directory(child)
+                    tree(child, depth - 1)
+        tree(self.path('walk'), 2 + self.scale // 4)
+
+    def walk(self):
+        stack = [self.path('walk')]
+        while stack:
+            path = stack.pop()
+            for name in self.call('readdir', path, None):
+                if name in ('.', '..'):
+                    continue
+                child = os.path.join(path, name)
+                if stat.S_ISDIR(self.call('getattr', child, None)['st_mode']):
+                    stack.append(child)
+
+    def prepare_seqread(self):
+        self.fixture(self.path('seqread', 'file'), 16 * 2**20 * self.scale)
+
+    def seqread(self):
+        path = self.path('seqread', 'file')
+        fh = self.call('open', path, os.O_RDONLY)
+        for offset in range(0, 16 * 2**20 * self.scale, 2**17):
+            self.bytes += len(self.call('read', path, 2**17, offset, fh))
+        self.call('release', path, fh)
+
+    def prepare_randread(self):
+        self.fixture(self.path('randread', 'file'), 16 * 2**20 * self.scale)
+
+    def randread(self):
+        path = self.path('randread', 'file')
+        size = 16 * 2**20 * self.scale
+        fh = self.call('open', path, os.O_RDONLY)
+        for _ in range(500 * self.scale):
+            offset = self.random.randrange(0, size - 4096) & ~4095
+            self.bytes += len(self.call('read', path, 4096, offset, fh))
+        self.call('release', path, fh)
+
+    def smallwrite(self):
+        data = os.urandom(4096)
+        for i in range(200 * self.scale):
+            path = self.path('smallwrite', 'f{}'.format(i))
+            fh = self.call('create', path, 0o644)
+            self.bytes += self.call('write', path, data, 0, fh)
+            self.call('release', path, fh)
+
+    def copy(self):
+        path = self.path('copy', 'file')
+        chunk = os.urandom(2**17)
+        fh = self.call('create', path, 0o644)
+        for offset in range(0, 32 * 2**20 * self.scale, len(chunk)):
+            self.bytes += self.call('write', path, chunk, offset, fh)
+        self.call('release', path, fh)
+
+
+def remove(sftp, path):
+    for attr in sftp.listdir_attr(path):
+        child = os.path.join(path, attr.filename)
+        if stat.S_ISDIR(attr.st_mode):
+            remove(sftp, child)
+        else:
+            sftp.unlink(child)
+    sftp.rmdir(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m oxfs.bench')
+    parser.add_argument('--backend', choices=['local', 'sftp'], default='local',
+                        help='local serves a temporary directory in process (default: local)')
+    parser.add_argument('--host', help='ssh host of the sftp backend (example: root@127.0.0.1)')
+    parser.add_argument('--ssh-port', dest='ssh_port', type=int, default=22)
+    parser.add_argument('--remote-path', dest='remote_path',
+                        help='writable directory the workloads run in (default: a temporary one)')
+    parser.add_argument('--rtt', type=float, default=0,
+                        help='milliseconds of latency the local backend adds to each request')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='MB/s limit of the local backend (default: unlimited)')
+    parser.add_argument('--workloads', default=','.join(WORKLOADS),
+                        help='comma separated, from: {}'.format(' '.join(WORKLOADS)))
+    parser.add_argument('--scale', type=int, default=1, help='multiplies file counts and sizes')
+    parser.add_argument('--parallel', type=int, default=8)
+    parser.add_argument('--output', help='json output file (default: stdout)')
+    args = parser.parse_args()
+
+    workloads = args.workloads.split(',')
+    for name in workloads:
+        if name not in WORKLOADS:
+            parser.error('unknown workload {}'.format(name))
+
+    user = host = backend = None
+    if 'sftp' == args.backend:
+        if not args.host or '@' not in args.host:
+            parser.error('--host user@host is required by the sftp backend')
+        user, _, host = args.host.partition('@')
+    else:
+        backend = LocalBackend(args.rtt, args.bandwidth)
+
+    remote = args.remote_path or ('/tmp' if backend is None else tempfile.mkdtemp())
+    cache = tempfile.mkdtemp()
+    fs = Oxfs(host, user, cache, remote, port=args.ssh_port, backend=backend)
+    fs.start_thread_pool(args.parallel)
+    fs.start_write_back(argparse.Namespace(writeback_interval=1))
+
+    root = '/oxfs-bench-{}'.format(os.getpid())
+    bench = Bench(fs, root, args.scale)
+    bench.directory(root)
+    results = dict()
+    try:
+        for name in workloads:
+            results[name] = bench.run(name)
+    finally:
+        fs.writeback.shutdown()
+        fs.taskpool.shutdown()
+        fs.transfer.shutdown()
+        sftp = fs.channel()
+        remove(sftp, fs.remotepath(root))
+        fs.release_channel()
+        fs.pool.close()
+        shutil.rmtree(cache, ignore_errors=True)
+        if backend is not None and not args.remote_path:
+            shutil.rmtree(remote, ignore_errors=True)
+
+    report = dict(backend=args.backend, rtt_ms=args.rtt, bandwidth_mbps=args.bandwidth,
+                  scale=args.scale, workloads=results)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            outfile.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
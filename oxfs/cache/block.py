@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+import ctypes
+import ctypes.util
+import os
+import platform
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+libc = None
+if 'Linux' == platform.system():
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+
+def punch(path, offset, length):
+    # give the disk space of an evicted block back, the file keeps its size
+    if libc is None:
+        return
+    try:
+        fd = os.open(path, os.O_WRONLY)
+    except OSError:
+        return
+    try:
+        libc.fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+                       ctypes.c_longlong(offset), ctypes.c_longlong(length))
+    finally:
+        os.close(fd)
+
+
+class BlockMap:
+    '''
+    Presence bitmap of a sparse cache file, one bit per block.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.bits = bytearray()
+        if os.path.exists(path):
+            with open(path, 'rb') as infile:
+                self.bits = bytearray(infile.read())
+
+    def test(self, index):
+        byte = index >> 3
+        if byte >= len(self.bits):
+            return False
+        return bool(self.bits[byte] & (1 << (index & 7)))
+
+    def set(self, index):
+        byte = index >> 3
+        if byte >= len(self.bits):
+            self.bits.extend(bytes(byte + 1 - len(self.bits)))
+        self.bits[byte] |= 1 << (index & 7)
+
+    def clear(self, index):
+        byte = index >> 3
+        if byte < len(self.bits):
+            self.bits[byte] &= ~(1 << (index & 7)) & 0xff
+
+    def indexes(self):
+        return [i for i in range(len(self.bits) << 3) if self.test(i)]
+
+    def empty(self):
+        return not any(self.bits)
+
+    def full(self, nblocks):
+        return all(self.test(i) for i in range(nblocks))
+
+    def save(self):
+        tmpfile = self.path + '.tmpfile'
+        with open(tmpfile, 'wb') as outfile:
+            outfile.write(self.bits)
+        os.rename(tmpfile, self.path)
+
+    def unlink(self):
+        try:
+            os.unlink(self.path)
+        except:
+            pass
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+import collections
+import os
+import struct
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+MAGIC = b'OXZ\x01'
+# magic, codec, frame size, raw size, frames, then frames + 1 offsets
+HEADER = struct.Struct('<4sB3xIQI')
+FRAME_SIZE = 2**17
+
+
+def codecs():
+    '''
+    The codecs this python can use, key: id, value: (name, compress, decompress).
+    '''
+    available = {1: ('zlib', lambda data: zlib.compress(data, 1), zlib.decompress)}
+    if lz4 is not None:
+        available[2] = ('lz4', lz4.block.compress, lz4.block.decompress)
+    if zstandard is not None:
+        available[3] = ('zstd', zstandard.ZstdCompressor(level=3).compress,
+                        zstandard.ZstdDecompressor().decompress)
+    return available
+
+
+CODECS = codecs()
+
+
+def codec(name):
+    '''
+    Returns the id of codec `name`, auto picks the best available, None for
+    no compression. Raises ValueError if it is not installed.
+    '''
+    if name in (None, 'none'):
+        return None
+    if 'auto' == name:
+        return max(CODECS)
+    for cid, (cname, _, _) in CODECS.items():
+        if cname == name:
+            return cid
+    raise ValueError('{} is not installed, pip install {}'.format(
+        name, 'zstandard' if 'zstd' == name else name))
+
+
+def compress(src, dst, cid, ratio=0.9):
+    '''
+    Writes `src` compressed frame by frame to `dst`, returns False and
+    writes nothing if it does not shrink to `ratio` of its size.
+    '''
+    encode = CODECS[cid][1]
+    frames, total = [], 0
+    with open(src, 'rb') as infile:
+        while True:
+            data = infile.read(FRAME_SIZE)
+            if not data:
+                break
+            total += len(data)
+            frames.append(encode(data))
+    packed = sum(len(frame) for frame in frames)
+    if not frames or packed + HEADER.size + 8 * (len(frames) + 1) > total * ratio:
+        return False
+
+    offset = HEADER.size + 8 * (len(frames) + 1)
+    offsets = [offset]
+    for frame in frames:
+        offset += len(frame)
+        offsets.append(offset)
+    with open(dst, 'wb') as outfile:
+        outfile.write(HEADER.pack(MAGIC, cid, FRAME_SIZE, total, len(frames)))
+        outfile.write(struct.pack('<{}Q'.format(len(offsets)), *offsets))
+        for frame in frames:
+            outfile.write(frame)
+    return True
+
+
+def decompress(src, dst):
+    '''
+    Writes the content of compressed `src` to `dst`.
+    '''
+    with open(src, 'rb') as infile:
+        packed = Compressed(infile.read())
+    with open(dst, 'wb') as outfile:
+        for i in range(packed.frames):
+            outfile.write(packed.frame(i))
+
+
+def compressed(name):
+    '''
+    True if `name` is a whole compressed cache file, checked beyond the
+    magic so a cached file that starts with it is not mistaken for one.
+    '''
+    try:
+        with open(name, 'rb') as infile:
+            header = infile.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return False
+            magic, cid, framesize, size, frames = HEADER.unpack(header)
+            if magic != MAGIC or not framesize or frames != -(-size // framesize):
+                return False
+            offsets = struct.unpack('<{}Q'.format(frames + 1), infile.read(8 * (frames + 1)))
+            return offsets[-1] == os.fstat(infile.fileno()).st_size
+    except (OSError, struct.error):
+        return False
+
+
+class Compressed:
+    '''
+    Random access to a compressed cache file held in `buffer`, an mmap or
+    bytes. Slicing it returns uncompressed bytes, the last frames decoded
+    are kept for sequential readers.
+    '''
+
+    def __init__(self, buffer, keep=4):
+        magic, cid, self.framesize, self.size, self.frames = HEADER.unpack_from(buffer)
+        if cid not in CODECS:
+            raise IOError('cache file compressed by missing codec {}'.format(cid))
+        self.decode = CODECS[cid][2]
+        self.offsets = struct.unpack_from('<{}Q'.format(self.frames + 1), buffer, HEADER.size)
+        self.buffer = buffer
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.decoded = collections.OrderedDict()  # key: frame index, value: bytes
+
+    def __len__(self):
+        return self.size
+
+    def frame(self, i):
+        with self.lock:
+            data = self.decoded.get(i)
+            if data is not None:
+                self.decoded.move_to_end(i)
+                return data
+        data = self.decode(self.buffer[self.offsets[i]:self.offsets[i + 1]])
+        with self.lock:
+            self.decoded[i] = data
+            while len(self.decoded) > self.keep:
+                self.decoded.popitem(last=False)
+        return data
+
+    def __getitem__(self, key):
+        start, stop, _ = key.indices(self.size)
+        if start >= stop:
+            return b''
+        first, last = start // self.framesize, (stop - 1) // self.framesize
+        data = b''.join(self.frame(i) for i in range(first, last + 1))
+        base = first * self.framesize
+        return data[start - base:stop - base]
+
+    def close(self):
+        if hasattr(self.buffer, 'close'):
+            self.buffer.close()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+import binascii
+import hashlib
+import json
+import logging
+import os
+import shlex
+import xxhash
+
+logger = logging.getLogger(__name__)
+
+REMOTE_DIGESTS = r'''
+import hashlib, sys
+try:
+    import xxhash
+    algo, new = 'xxh64', xxhash.xxh64
+except ImportError:
+    algo, new = 'md5', hashlib.md5
+path, blocksize = sys.argv[1], int(sys.argv[2])
+print(algo)
+with open(path, 'rb') as infile:
+    for block in iter(lambda: infile.read(blocksize), b''):
+        print(new(block).hexdigest())
+'''
+
+
+def hasher(algo):
+    if 'xxh64' == algo:
+        return xxhash.xxh64
+    return lambda data: hashlib.new(algo, data)
+
+
+def block_digests(path, blocksize, algo='xxh64'):
+    new = hasher(algo)
+    digests = []
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(blocksize), b''):
+            digests.append(new(block).hexdigest())
+    return digests
+
+
+def remote_digests(client, sftp, path, blocksize):
+    '''
+    Returns (algo, digests) of every block of the remote file, from a helper
+    run over ssh or from the sftp check-file extension, or (None, None).
+    '''
+    try:
+        command = 'python3 -c {} {} {}'.format(
+            shlex.quote(REMOTE_DIGESTS), shlex.quote(path), blocksize)
+        stdin, stdout, stderr = client.exec_command(command)
+        lines = stdout.read().decode('utf-8').split()
+        status = stdout.channel.recv_exit_status()
+        stdin.close(), stdout.close(), stderr.close()
+        if 0 == status and lines:
+            return lines[0], lines[1:]
+    except Exception as e:
+        logger.debug(e)
+
+    try:
+        with sftp.open(path, 'rb') as infile:
+            raw = infile.check('md5', 0, 0, blocksize)
+        digests = [binascii.hexlify(raw[i:i + 16]).decode('ascii')
+                   for i in range(0, len(raw), 16)]
+        return 'md5', digests
+    except Exception as e:
+        logger.debug(e)
+    return None, None
+
+
+def content_digest(chunks):
+    # sha256 of the content given in `chunks`, the digest of the object store
+    h = hashlib.sha256()
+    for chunk in chunks:
+        h.update(chunk)
+    return h.hexdigest()
+
+
+def remote_digest(client, path):
+    '''
+    Returns the sha256 of the remote file from sha256sum or shasum run over
+    ssh, or None.
+    '''
+    try:
+        command = 'sha256sum -- {0} 2>/dev/null || shasum -a 256 -- {0}'.format(shlex.quote(path))
+        stdin, stdout, stderr = client.exec_command(command)
+        words = stdout.read().decode('utf-8').split()
+        status = stdout.channel.recv_exit_status()
+        stdin.close(), stdout.close(), stderr.close()
+        # names with a newline or a backslash get their digest escaped
+        if 0 == status and words and 64 == len(words[0].lstrip('\\')):
+            return words[0].lstrip('\\')
+    except Exception as e:
+        logger.debug(e)
+    return None
+
+
+class Digests:
+    '''
+    Block digests of a cache file, stored beside it with the size and mtime
+    they were computed at.
+    '''
+
+    def __init__(self, path, blocksize):
+        self.path = path
+        self.blocksize = blocksize
+
+    def load(self, cachefile, algo):
+        st = os.lstat(cachefile)
+        try:
+            with open(self.path, 'r') as infile:
+                stored = json.load(infile)
+            if [algo, self.blocksize, st.st_size, st.st_mtime_ns] == stored['key']:
+                return stored['digests']
+        except (OSError, ValueError, KeyError):
+            pass
+        digests = block_digests(cachefile, self.blocksize, algo)
+        self.save(cachefile, algo, digests)
+        return digests
+
+    def save(self, cachefile, algo, digests):
+        st = os.lstat(cachefile)
+        tmpfile = self.path + '.tmpfile'
+        with open(tmpfile, 'w') as outfile:
+            json.dump(dict(key=[algo, self.blocksize, st.st_size, st.st_mtime_ns],
+                           digests=digests), outfile)
+        os.rename(tmpfile, self.path)
@@ -1,36 +1,286 @@
 #!/usr/bin/env python
 
 import collections
+import json
 import logging
 import os
+import shutil
 import threading
+import time
 import xxhash
 
+from oxfs.cache import compress
+from oxfs.cache.block import BlockMap, punch
+from oxfs.cache.digest import content_digest
+from oxfs.cache.mapped import MappedFiles
+from oxfs.cache.meta import METADB
+from oxfs.cache.policy import POLICIES
+
+INDEX = 'index.json'
+OBJECTS = 'objects'
+
 
 class CacheManager:
-    def __init__(self, cache_path, max_disk_size_mb=2**10):
+    '''
+    Cache files are named by the hash of their remote path. With `dedup`
+    whole files are also hard links to objects/<sha256 of their content>,
+    so the paths of identical content share one file. A shared file is
+    copied before it is changed in place and its space is freed with its
+    last link.
+    '''
+
+    def __init__(self, cache_path, max_disk_size_mb=2**10, sync_max_size_mb=2**6, block_size_kb=2**10,
+                 max_files=0, min_free_mb=0, policy='lru', pinned=(), mapped_files=256,
+                 compression=None, dedup=False):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.cache_path = cache_path
         self.maxsize = max_disk_size_mb << 20
+        self.syncsize = min(sync_max_size_mb << 20, self.maxsize)
+        self.blocksize = block_size_kb << 10
+        self.maxfiles = max_files
+        self.minfree = min_free_mb << 20
+        self.prefixes = [os.path.normpath(prefix) for prefix in pinned]
         self.size = 0
-        self.cache = collections.OrderedDict()  # key: file name, value: file size
+        self.files = 0
+        # key: file name or (file name, block index), value: size
+        self.cache = POLICIES[policy]()
+        self.pinned = dict()  # entries under a pinned prefix, never evicted
+        self.blocks = dict()  # key: file name, value: BlockMap of its partfile
+        self.held = collections.Counter()  # blocks being served, not evicted meanwhile
+        self.paths = dict()  # key: file name, value: remote path
+        self.validators = dict()  # key: file name, value: remote [mtime, size] it matches
+        self.codec = compress.codec(compression)
+        self.compressed = set()  # names of the compressed cache files
+        self.dedup = dedup
+        self.objects_path = os.path.join(cache_path, OBJECTS)
+        self.digests = dict()  # key: file name, value: digest of the object it links
+        self.objects = dict()  # key: digest, value: [size, names linking it]
+        self.shared = 0  # bytes counted by the entries of each object but one
+        self.running = True
         self.lock = threading.Lock()
+        self.listeners = []  # called with the name of each removed cache file
+        self.mapped = MappedFiles(mapped_files, self.iscompressed)
         self.initialize()
 
     def initialize(self):
-        if not os.path.exists(self.cache_path):
-            os.makedirs(self.cache_path)
-            return
-        names = os.listdir(self.cache_path)
+        if not os.path.exists(self.objects_path):
+            os.makedirs(self.objects_path)
+        names = set(os.listdir(self.cache_path))
+        names.discard(OBJECTS)
+        for entry in self.load():
+            name, index, size, path, validator = entry[:5]
+            key = os.path.join(self.cache_path, name)
+            if index is None:
+                if name not in names:
+                    continue
+                names.discard(name)
+            else:
+                blocks = self.loadmap(key, names)
+                if blocks is None or not blocks.test(index):
+                    continue
+            if path is not None:
+                self.paths[key] = path
+            if validator is not None:
+                self.validators[key] = validator
+            if entry[5:6] == [True]:
+                self.compressed.add(key)
+            self.store(key if index is None else (key, index), size)
+            digest = entry[6] if len(entry) > 6 else None
+            if digest is not None and self.links(key, digest):
+                self.ref(key, digest, size)
+
+        # files cached after the last checkpoint
         for name in names:
             path = os.path.join(self.cache_path, name)
-            self.cache[path] = os.lstat(path).st_size
+            if name.startswith(METADB) or name == INDEX:
+                continue
+            if path.endswith('.digest'):
+                # the block digests of a file no longer cached
+                if not os.path.exists(path[:-len('.digest')]):
+                    self.unlink(path)
+                continue
+            if path.endswith('.bitmap'):
+                continue
+            if path.endswith('.tmpfile'):
+                self.unlink(path)
+                continue
+            if path.endswith('.part'):
+                key = path[:-len('.part')]
+                blocks = self.loadmap(key, names)
+                for index in blocks.indexes():
+                    if self.entry((key, index)) is None:
+                        self.store((key, index), self.blocksize)
+                continue
+            st = os.lstat(path)
+            if st.st_nlink > 1:
+                # linked to an object nobody knows, it would change with it
+                self.unlink(path)
+                continue
+            if compress.compressed(path):
+                self.compressed.add(path)
+            self.store(path, st.st_size)
+
+        # objects no cache file is known to link, a link left keeps its data
+        for name in os.listdir(self.objects_path):
+            if name not in self.objects:
+                self.unlink(os.path.join(self.objects_path, name))
+
+    def links(self, key, digest):
+        try:
+            return os.path.samefile(key, self.objectfile(digest))
+        except OSError:
+            return False
+
+    def loadmap(self, key, names):
+        blocks = self.blocks.get(key)
+        if blocks is None and os.path.basename(self.partfile(key)) in names:
+            blocks = BlockMap(self.mapfile(key))
+            self.blocks[key] = blocks
+        return blocks
+
+    def load(self):
+        try:
+            with open(os.path.join(self.cache_path, INDEX), 'r') as infile:
+                return json.load(infile)
+        except (OSError, ValueError) as e:
+            self.logger.debug(e)
+            return []
+
+    def checkpoint(self):
+        '''
+        Writes the index of cached files in LRU order, so a restart gets the
+        order and sizes back without stating every file.
+        '''
+        entries = []
+        with self.lock:
+            for k, size in list(self.pinned.items()) + self.cache.items():
+                key, index = k if type(k) == tuple else (k, None)
+                entries.append([os.path.basename(key), index, size,
+                                self.paths.get(key), self.validators.get(key),
+                                key in self.compressed, self.digests.get(key)])
+        path = os.path.join(self.cache_path, INDEX)
+        with open(path + '.tmpfile', 'w') as outfile:
+            json.dump(entries, outfile)
+        os.rename(path + '.tmpfile', path)
+
+    def run(self, interval):
+        self.thread = threading.Thread(target=self.loop, args=(interval,))
+        self.thread.daemon = True
+        self.thread.name = 'cache-index'
+        self.thread.start()
+
+    def shutdown(self):
+        self.running = False
+        self.checkpoint()
+        self.mapped.clear()
+
+    def loop(self, interval):
+        while self.running:
+            time.sleep(interval)
+            self.checkpoint()
+
+    def validator(self, key):
+        with self.lock:
+            return self.validators.get(key)
 
     def copy(self):
         with self.lock:
-            return self.cache.copy()
+            entries = self.cache.copy()
+            entries.update(self.pinned)
+            return entries
+
+    def covers(self, path):
+        # True if `path` is under a pinned prefix
+        return any(path == prefix or path.startswith(prefix.rstrip('/') + '/')
+                   for prefix in self.prefixes)
+
+    def ispinned(self, key):
+        path = self.paths.get(key)
+        return path is not None and self.covers(path)
+
+    def pin(self, prefix):
+        '''
+        Pins the remote `prefix`, the files cached below it are not evicted
+        from now on.
+        '''
+        with self.lock:
+            prefix = os.path.normpath(prefix)
+            if prefix in self.prefixes:
+                return
+            self.prefixes.append(prefix)
+            for k, size in self.cache.items():
+                if self.ispinned(k[0] if type(k) == tuple else k):
+                    self.cache.pop(k)
+                    self.pinned[k] = size
+
+    def entry(self, k):
+        size = self.pinned.get(k)
+        if size is None:
+            size = self.cache.get(k)
+        return size
+
+    def store(self, k, size):
+        # inserts or refreshes an entry, counts as an access
+        old = self.entry(k)
+        if old is not None:
+            self.size -= old
+        elif type(k) != tuple:
+            self.files += 1
+        if self.ispinned(k[0] if type(k) == tuple else k):
+            self.cache.pop(k, None)
+            self.pinned[k] = size
+        else:
+            self.pinned.pop(k, None)
+            self.cache.put(k, size)
+        self.size += size
+
+    def drop(self, k):
+        size = self.pinned.pop(k, None)
+        if size is None:
+            size = self.cache.pop(k, None)
+        if size is not None:
+            self.size -= size
+            if type(k) != tuple:
+                self.files -= 1
+        return size
+
+    def usage(self):
+        # bytes on disk, an object linked by several files counts once
+        return self.size - self.shared
+
+    def objectfile(self, digest):
+        return os.path.join(self.objects_path, digest)
+
+    def ref(self, key, digest, size):
+        objects = self.objects.setdefault(digest, [size, set()])
+        objects[1].add(key)
+        if len(objects[1]) > 1:
+            self.shared += objects[0]
+        self.digests[key] = digest
+
+    def unref(self, key):
+        '''
+        Unlinks `key` from its object, returns the object files to remove.
+        '''
+        digest = self.digests.pop(key, None)
+        if digest is None:
+            return []
+        size, names = self.objects[digest]
+        names.discard(key)
+        if names:
+            self.shared -= size
+            return []
+        del self.objects[digest]
+        return [self.objectfile(digest)]
+
+    def shares(self, key):
+        digest = self.digests.get(key)
+        return digest is not None and len(self.objects[digest][1]) > 1
 
     def unlink(self, path):
+        self.mapped.invalidate(path)
+        for listener in self.listeners:
+            listener(path)
         try:
             os.unlink(path)
         except:
@@ -38,30 +288,369 @@ class CacheManager:
 
     def pop(self, key):
         with self.lock:
-            self.cache.pop(key, None)
+            self.drop(key)
+            self.paths.pop(key, None)
+            self.validators.pop(key, None)
+            self.compressed.discard(key)
+            objects = self.unref(key)
+            blocks = self.blocks.pop(key, None)
+            if blocks is not None:
+                for index in blocks.indexes():
+                    self.drop((key, index))
         self.unlink(key)
+        for f in objects:
+            self.unlink(f)
+        self.unlink(self.digestfile(key))
+        if blocks is not None:
+            self.unlink(self.partfile(key))
+            blocks.unlink()
+
+    def move(self, src, dst, path):
+        '''
+        Moves the cache of `src` to `dst`, the cache file of the remote
+        `path` it was renamed to. Its files are renamed, its entries keep
+        their sizes.
+        '''
+        if src == dst:
+            return
+        self.pop(dst)
+        self.mapped.invalidate(src)
+        with self.lock:
+            remote = self.paths.pop(src, None)
+            if remote is not None:
+                self.paths[dst] = path
+            validator = self.validators.pop(src, None)
+            if validator is not None:
+                self.validators[dst] = validator
+            if src in self.compressed:
+                self.compressed.discard(src)
+                self.compressed.add(dst)
+            digest = self.digests.pop(src, None)
+            if digest is not None:
+                names = self.objects[digest][1]
+                names.discard(src)
+                names.add(dst)
+                self.digests[dst] = digest
+
+            for a, b in ((src, dst), (self.digestfile(src), self.digestfile(dst)),
+                         (self.partfile(src), self.partfile(dst))):
+                try:
+                    os.rename(a, b)
+                except FileNotFoundError:
+                    pass
+            blocks = self.blocks.pop(src, None)
+            moves = [(src, dst)]
+            if blocks is not None:
+                os.rename(blocks.path, self.mapfile(dst))
+                blocks.path = self.mapfile(dst)
+                self.blocks[dst] = blocks
+                moves.extend(((src, index), (dst, index)) for index in blocks.indexes())
+            for k, moved in moves:
+                size = self.drop(k)
+                if size is not None:
+                    self.store(moved, size)
+        # handles still hold the old name
+        for listener in self.listeners:
+            listener(src)
+
+    def below(self, prefix):
+        # remote paths of the files cached below the directory `prefix`
+        prefix = prefix.rstrip('/') + '/'
+        with self.lock:
+            return [path for path in self.paths.values() if path.startswith(prefix)]
 
     def cachefile(self, path):
         return os.path.join(self.cache_path, xxhash.xxh64_hexdigest(path))
 
+    def partfile(self, key):
+        return key + '.part'
+
+    def mapfile(self, key):
+        return key + '.bitmap'
+
+    def digestfile(self, key):
+        return key + '.digest'
+
     def renew(self, key):
         with self.lock:
-            if self.cache.get(key, None) is not None:
-                self.cache.move_to_end(key)
-
-    def put(self, key):
-        files = []
-        with self.lock:
-            old = self.cache.pop(key, None)
-            if old is not None:
-                self.size -= old
-            size = os.lstat(key).st_size
-            self.size += size
-            self.cache[key] = size
-            self.cache.move_to_end(key)
-            while self.size > self.maxsize:
-                k, s = self.cache.popitem(last=False)
-                self.size -= s
-                files.append(k)
-        for f in files:
+            self.cache.touch(key)
+
+    def overflow(self):
+        # bytes to free for the disk to keep min_free_mb available
+        if not self.minfree:
+            return 0
+        st = os.statvfs(self.cache_path)
+        return max(self.minfree - st.f_bavail * st.f_frsize, 0)
+
+    def hold(self, key, offset, size):
+        '''
+        Keeps the blocks of `key` covering [offset, offset + size) from
+        eviction until `unhold`, a punched block would read as zeros. The
+        partfile and its map are kept meanwhile, for the blocks being
+        fetched.
+        '''
+        first, last = offset // self.blocksize, (offset + max(size, 1) - 1) // self.blocksize
+        held = [key] + [(key, index) for index in range(first, last + 1)]
+        with self.lock:
+            self.held.update(held)
+        return held
+
+    def unhold(self, held):
+        with self.lock:
+            self.held.subtract(held)
+            self.held += collections.Counter()
+
+    def evict(self, keep=()):
+        # never the entries just put, a policy may rank a new entry lowest.
+        # Files are removed and holes punched under the lock, done later
+        # they would hit a file or block cached again meanwhile
+        skipped = []
+        need = self.overflow()
+        while len(self.cache) and (self.usage() > self.maxsize or need > 0 or
+                                   (self.maxfiles and self.files + len(self.blocks) > self.maxfiles)):
+            k, s = self.cache.victim()
+            if k in self.held or k in keep:
+                skipped.append((k, s))
+                continue
+            self.size -= s
+            if type(k) != tuple:
+                # a file sharing its object frees no space
+                if not self.shares(k):
+                    need -= s
+                self.files -= 1
+                self.paths.pop(k, None)
+                self.validators.pop(k, None)
+                self.compressed.discard(k)
+                for f in [k, self.digestfile(k)] + self.unref(k):
+                    self.unlink(f)
+                continue
+            need -= s
+            key, index = k
+            blocks = self.blocks.get(key)
+            if blocks is None:
+                continue
+            blocks.clear(index)
+            if blocks.empty() and key not in self.held:
+                del self.blocks[key]
+                self.paths.pop(key, None)
+                self.unlink(self.partfile(key))
+                self.unlink(blocks.path)
+            else:
+                blocks.save()
+                punch(self.partfile(key), index * self.blocksize, self.blocksize)
+        # back as recently used, they are being read
+        for k, s in skipped:
+            self.cache.put(k, s)
+
+    def put(self, key, path=None, validator=None, packed=False):
+        # the file may have been replaced
+        self.mapped.invalidate(key)
+        with self.lock:
+            if path is not None:
+                self.paths[key] = path
+            self.validators.pop(key, None)
+            if validator is not None:
+                self.validators[key] = validator
+            if packed:
+                self.compressed.add(key)
+            else:
+                self.compressed.discard(key)
+            self.store(key, os.lstat(key).st_size)
+            self.evict((key,))
+
+    def iscompressed(self, key):
+        with self.lock:
+            return key in self.compressed
+
+    def pack(self, name):
+        '''
+        Compresses the downloaded file `name` in place if a codec is set and
+        it pays off, returns True if it did.
+        '''
+        if self.codec is None:
+            return False
+        tmpfile = name + '.tmpfile'
+        if not compress.compress(name, tmpfile, self.codec):
+            return False
+        os.rename(tmpfile, name)
+        return True
+
+    def compact(self, key):
+        '''
+        Compresses and deduplicates the whole cache file `key` like a file
+        downloaded ahead of use.
+        '''
+        if not self.iscompressed(key) and os.lstat(key).st_size <= self.syncsize \
+                and self.pack(key):
+            for listener in self.listeners:
+                listener(key)
+            self.put(key, None, self.validator(key), True)
+        self.intern(key)
+
+    def writable(self, key):
+        '''
+        Makes the cache file `key` safe to change in place, a compressed
+        file is written back raw and a file linked to an object gets a copy
+        of its own.
+        '''
+        with self.lock:
+            packed = key in self.compressed
+            if not packed and key not in self.digests:
+                return
+        tmpfile = key + '.tmpfile'
+        if packed:
+            compress.decompress(key, tmpfile)
+        else:
+            shutil.copyfile(key, tmpfile)
+        self.mapped.invalidate(key)
+        os.rename(tmpfile, key)
+        # handles still hold the old file open
+        for listener in self.listeners:
+            listener(key)
+        with self.lock:
+            objects = self.unref(key)
+        for f in objects:
             self.unlink(f)
+        self.put(key, None, self.validator(key))
+
+    def digest(self, key):
+        # of the content, a compressed file is decoded first
+        if self.iscompressed(key):
+            with open(key, 'rb') as infile:
+                packed = compress.Compressed(infile.read())
+            return content_digest(packed.frame(i) for i in range(packed.frames))
+        with open(key, 'rb') as infile:
+            return content_digest(iter(lambda: infile.read(2**20), b''))
+
+    def link(self, key, digest):
+        # replaces `key` by a link to the object, called with the lock held
+        if not self.links(key, digest):
+            tmpfile = key + '.tmpfile'
+            os.link(self.objectfile(digest), tmpfile)
+            os.rename(tmpfile, key)
+        size, names = self.objects[digest]
+        packed = any(name in self.compressed for name in names)
+        objects = self.unref(key)
+        self.ref(key, digest, size)
+        return packed, objects
+
+    def relinked(self, key, path, validator, packed, objects):
+        for f in objects:
+            self.unlink(f)
+        for listener in self.listeners:
+            listener(key)
+        self.put(key, path, validator, packed)
+
+    def intern(self, key, digest=None):
+        '''
+        Links the whole cache file `key` to the object of its content, which
+        it becomes if there is none yet. Returns the digest, or None if dedup
+        is off or `key` is not cached.
+        '''
+        if not self.dedup:
+            return None
+        try:
+            digest = digest or self.digest(key)
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            if self.digests.get(key) == digest:
+                return digest
+            if digest in self.objects:
+                packed, objects = self.link(key, digest)
+            else:
+                objectfile = self.objectfile(digest)
+                os.link(key, objectfile + '.tmpfile')
+                os.rename(objectfile + '.tmpfile', objectfile)
+                objects = self.unref(key)
+                self.ref(key, digest, os.lstat(key).st_size)
+                packed = None
+        if packed is None:
+            for f in objects:
+                self.unlink(f)
+        else:
+            self.relinked(key, None, self.validator(key), packed, objects)
+        return digest
+
+    def clone(self, digest, key, path=None, validator=None):
+        '''
+        Makes `key` a cache file of the stored object `digest`, returns False
+        if there is no such object.
+        '''
+        with self.lock:
+            if digest not in self.objects:
+                return False
+            packed, objects = self.link(key, digest)
+        self.relinked(key, path, validator, packed, objects)
+        return True
+
+    def share(self, src, dst, path=None, validator=None):
+        '''
+        Makes `dst` a cache file of the content of the whole cache file `src`
+        without copying it, returns False if dedup is off or `src` is not
+        cached.
+        '''
+        digest = self.intern(src)
+        return digest is not None and self.clone(digest, dst, path, validator)
+
+    def duplicate(self, src, dst, path=None, validator=None):
+        '''
+        Makes `dst` a cache file of the content of the whole cache file `src`,
+        shared if dedup is on, else copied. Returns False if `src` is not
+        cached.
+        '''
+        if self.share(src, dst, path, validator):
+            return True
+        tmpfile = dst + '.tmpfile'
+        try:
+            shutil.copyfile(src, tmpfile)
+        except FileNotFoundError:
+            return False
+        os.rename(tmpfile, dst)
+        self.put(dst, path, validator, self.iscompressed(src))
+        return True
+
+    def blockmap(self, key, size=None):
+        '''
+        Returns the BlockMap of a partially cached file, a sparse partfile of
+        `size` bytes is created on first use when size is given.
+        '''
+        with self.lock:
+            blocks = self.blocks.get(key)
+            if blocks is None and size is not None:
+                with open(self.partfile(key), 'wb') as outfile:
+                    outfile.truncate(size)
+                blocks = BlockMap(self.mapfile(key))
+                self.blocks[key] = blocks
+            return blocks
+
+    def put_blocks(self, key, indexes, path=None):
+        with self.lock:
+            if path is not None:
+                self.paths[key] = path
+            blocks = self.blocks[key]
+            for index in indexes:
+                blocks.set(index)
+                self.store((key, index), self.blocksize)
+            blocks.save()
+            self.evict(set((key, index) for index in indexes))
+
+    def complete(self, key):
+        '''
+        Promotes a partfile to a whole cache file once every block is present.
+        '''
+        with self.lock:
+            blocks = self.blocks.get(key)
+            if blocks is None:
+                return os.path.exists(key)
+            partfile = self.partfile(key)
+            nblocks = -(-os.lstat(partfile).st_size // self.blocksize)
+            if not blocks.full(nblocks):
+                return False
+            del self.blocks[key]
+            for index in blocks.indexes():
+                self.drop((key, index))
+            os.rename(partfile, key)
+        blocks.unlink()
+        self.put(key, self.paths.get(key))
+        return True
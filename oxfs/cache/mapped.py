@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+import collections
+import mmap
+import os
+import threading
+
+from oxfs.cache.compress import Compressed
+
+
+class MappedFiles:
+    '''
+    Read-only mmaps of up to `maxfiles` cache files, least recently used
+    first out, so a cached read is a slice of the page cache with no
+    open, seek or read call. The files `packed(name)` says are compressed
+    are decoded through their mapping. A mapping must be invalidated
+    before its file is replaced, written or truncated, touching pages past
+    a shrunk end of file is fatal.
+    '''
+
+    def __init__(self, maxfiles=256, packed=lambda name: False):
+        self.maxfiles = maxfiles
+        self.packed = packed
+        self.lock = threading.Lock()
+        self.maps = collections.OrderedDict()  # key: file name, value: mmap
+        self.version = 0  # bumped by each invalidation
+
+    def get(self, name):
+        with self.lock:
+            m = self.maps.get(name)
+            if m is not None:
+                self.maps.move_to_end(name)
+                return m
+            version = self.version
+
+        try:
+            fd = os.open(name, os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        try:
+            size = os.fstat(fd).st_size
+            # an empty file can not be mapped, slicing b'' reads the same
+            m = mmap.mmap(fd, size, access=mmap.ACCESS_READ) if size else b''
+        finally:
+            os.close(fd)
+        if m and self.packed(name):
+            m = Compressed(m)
+
+        with self.lock:
+            # a mapping made across an invalidation only serves this read
+            if self.maxfiles and version == self.version and name not in self.maps:
+                self.maps[name] = m
+                while len(self.maps) > self.maxfiles:
+                    self.close(self.maps.popitem(last=False)[1])
+        return m
+
+    def pread(self, name, size, offset):
+        '''
+        Returns None if `name` does not exist.
+        '''
+        while True:
+            m = self.get(name)
+            if m is None:
+                return None
+            try:
+                return m[offset:offset + size]
+            except ValueError:
+                # closed by an invalidation meanwhile
+                continue
+
+    def invalidate(self, name):
+        with self.lock:
+            self.version += 1
+            m = self.maps.pop(name, None)
+        self.close(m)
+
+    @staticmethod
+    def close(m):
+        if m:
+            m.close()
+
+    def clear(self):
+        with self.lock:
+            self.version += 1
+            maps, self.maps = self.maps, collections.OrderedDict()
+        for m in maps.values():
+            self.close(m)
@@ -1,32 +1,245 @@
 #!/usr/bin/env python
 
 import collections
+import json
+import os
+import sqlite3
 import threading
+import time
+
+METADB = 'meta.db'
+REMOVED = object()
+
+
+class MetaStore:
+    '''
+    On disk copy of the attribute and directory caches, so a remount does
+    not start from an empty cache.
+    '''
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (kind TEXT, path TEXT, '
+                        'value TEXT, fetched REAL, PRIMARY KEY (kind, path))')
+        self.db.commit()
+
+    def get(self, kind, path):
+        with self.lock:
+            row = self.db.execute('SELECT value, fetched FROM meta WHERE kind = ? AND path = ?',
+                                  (kind, path)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def update(self, kind, puts, removes):
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?, ?, ?)',
+                                [(kind, k, json.dumps(v), fetched) for k, (v, fetched) in puts])
+            self.db.executemany('DELETE FROM meta WHERE kind = ? AND path = ?',
+                                [(kind, k) for k in removes])
+            self.db.commit()
+
+    def move(self, kind, old, new):
+        # the rows at or below `old` are renamed to `new`, the ones there dropped
+        below = lambda prefix: ('(path = ? OR substr(path, 1, ?) = ?)',
+                                (prefix, len(prefix) + 1, prefix + '/'))
+        where, args = below(new)
+        with self.lock:
+            self.db.execute('DELETE FROM meta WHERE kind = ? AND ' + where, (kind,) + args)
+            where, args = below(old)
+            self.db.execute('UPDATE meta SET path = ? || substr(path, ?) WHERE kind = ? AND ' + where,
+                            (new, len(old) + 1, kind) + args)
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
 
 
 class Cache:
-    def __init__(self, maxsize=2**18):
+    '''
+    LRU of [value, expires, accessed], `ttl(value)` returns the lifetime of a
+    value in seconds or None to keep it until evicted. Keys are paths, an
+    index of their parents finds the entries below a directory without a
+    scan.
+    '''
+
+    def __init__(self, maxsize=2**18, ttl=None):
         self.lock = threading.Lock()
         self.maxsize = maxsize
+        self.ttl = ttl
         self.cache = collections.OrderedDict()
+        self.children = dict()  # key: path, value: the paths below it holding entries
+        self.store = None
+        self.kind = None
+        self.dirty = dict()  # changes not yet written to the store
+
+    def attach(self, store, kind):
+        self.store = store
+        self.kind = kind
+
+    def index(self, k):
+        # a path not cached still links the entries below it
+        while True:
+            parent = os.path.dirname(k)
+            if parent == k:
+                return
+            children = self.children.setdefault(parent, set())
+            if k in children:
+                return
+            children.add(k)
+            k = parent
+
+    def unindex(self, k):
+        while k not in self.cache and not self.children.get(k):
+            self.children.pop(k, None)
+            parent = os.path.dirname(k)
+            children = self.children.get(parent)
+            if parent == k or children is None:
+                return
+            children.discard(k)
+            k = parent
+
+    def below(self, prefix):
+        # `prefix` and the cached keys below it, called with the lock held
+        keys, level = [], [prefix]
+        while level:
+            keys.extend(k for k in level if k in self.cache)
+            level = [child for k in level for child in self.children.get(k, ())]
+        return keys
 
     def remove(self, k):
         with self.lock:
-            self.cache.pop(k, None)
+            if self.cache.pop(k, None) is not None:
+                self.unindex(k)
+            if self.store is not None:
+                self.dirty[k] = REMOVED
+
+    def move(self, old, new):
+        '''
+        Renames `old` and the entries below it to `new`, keeping their values
+        and lifetimes, the entries at or below `new` are dropped.
+        '''
+        # the store holds every change made so far, it is renamed the same
+        self.sync()
+        now = time.time()
+        with self.lock:
+            moved = [(k, self.cache.pop(k)) for k in self.below(old)]
+            for k in self.below(new):
+                del self.cache[k]
+                self.unindex(k)
+                if self.store is not None:
+                    self.dirty[k] = REMOVED
+            for k, entry in moved:
+                self.unindex(k)
+                key = new + k[len(old):]
+                self.cache[key] = entry
+                self.index(key)
+                if self.store is not None:
+                    self.dirty[k] = REMOVED
+                    self.dirty[key] = (entry[0], now)
+        if self.store is not None:
+            self.store.move(self.kind, old, new)
 
     def copy(self):
         with self.lock:
-            return self.cache.copy()
+            return collections.OrderedDict((k, e[0]) for k, e in self.cache.items())
+
+    def due(self, horizon, since, keep=None):
+        '''
+        Returns (key, value, accessed) of the entries that expire within
+        `horizon` seconds and were read after `since` or are `keep(key)`,
+        the ones worth refreshing before they expire.
+        '''
+        deadline = time.time() + horizon
+        with self.lock:
+            return [(k, e[0], e[2]) for k, e in self.cache.items()
+                    if e[1] is not None and e[1] < deadline and
+                    (e[2] > since or keep is not None and keep(k))]
+
+    def expire(self, prefix=None):
+        '''
+        Expires `prefix` and the entries below it, or every entry.
+        '''
+        now = time.time()
+        with self.lock:
+            keys = self.cache if prefix is None else self.below(prefix)
+            for k in keys:
+                self.cache[k][1] = now
+
+    def peek(self, k):
+        # the value even if expired, without counting as an access
+        with self.lock:
+            entry = self.cache.get(k)
+            return entry[0] if entry is not None else None
 
     def get(self, k):
+        now = time.time()
         with self.lock:
-            v = self.cache.get(k, None)
-            if v is not None:
+            entry = self.cache.get(k)
+            if entry is not None:
+                if entry[1] is not None and entry[1] < now:
+                    return None
+                entry[2] = now
                 self.cache.move_to_end(k)
-            return v
+                return entry[0]
+            if self.store is None or k in self.dirty:
+                return None
 
-    def put(self, k, v):
+        # entries from a previous mount live from the time they were
+        # fetched, those without a lifetime missed the changes made since
+        # and are due at once
+        loaded = self.store.get(self.kind, k)
+        if loaded is None:
+            return None
+        value, fetched = loaded
         with self.lock:
+            if k not in self.cache and k not in self.dirty:
+                self.insert(k, value, fetched, now)
+                entry = self.cache[k]
+                if entry[1] is None:
+                    entry[1] = fetched
+            entry = self.cache.get(k)
+            if entry is None or entry[1] is not None and entry[1] < now:
+                return None
+            return entry[0]
+
+    def insert(self, k, v, now, accessed=None):
+        if k not in self.cache:
             if len(self.cache) >= self.maxsize:
-                self.cache.popitem(last=False)
-            self.cache[k] = v
+                self.unindex(self.cache.popitem(last=False)[0])
+            self.index(k)
+        ttl = self.ttl(v) if self.ttl is not None else None
+        self.cache[k] = [v, now + ttl if ttl is not None else None, accessed or now]
+
+    def put(self, k, v, refresh=False):
+        '''
+        A `refresh` renews the value without counting as an access.
+        '''
+        now = time.time()
+        with self.lock:
+            entry = self.cache.get(k)
+            accessed = entry[2] if refresh and entry is not None else None
+            self.insert(k, v, now, accessed)
+            if self.store is not None:
+                self.dirty[k] = (v, now)
+
+    def replace(self, k, v):
+        # a new value for a cached entry, its lifetime is kept
+        with self.lock:
+            entry = self.cache.get(k)
+            if entry is None:
+                return
+            entry[0] = v
+            if self.store is not None:
+                self.dirty[k] = (v, time.time())
+
+    def sync(self):
+        if self.store is None:
+            return
+        with self.lock:
+            dirty, self.dirty = self.dirty, dict()
+        puts = [(k, v) for k, v in dirty.items() if v is not REMOVED]
+        removes = [k for k, v in dirty.items() if v is REMOVED]
+        self.store.update(self.kind, puts, removes)
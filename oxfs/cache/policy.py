@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+import collections
+import heapq
+import itertools
+
+
+class LRU:
+    '''
+    Eviction order of cache entries, key: file name or (file name, block
+    index), value: size. Evicts the least recently used entry.
+    '''
+
+    def __init__(self):
+        self.entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, k):
+        return k in self.entries
+
+    def get(self, k, default=None):
+        return self.entries.get(k, default)
+
+    def items(self):
+        return list(self.entries.items())
+
+    def values(self):
+        return list(self.entries.values())
+
+    def copy(self):
+        return collections.OrderedDict(self.items())
+
+    def put(self, k, size):
+        self.entries.pop(k, None)
+        self.entries[k] = size
+
+    def pop(self, k, default=None):
+        return self.entries.pop(k, default)
+
+    def touch(self, k):
+        if k in self.entries:
+            self.entries.move_to_end(k)
+
+    def victim(self):
+        return self.entries.popitem(last=False)
+
+
+class TwoQ(LRU):
+    '''
+    Simplified 2Q, new entries wait in a FIFO probation queue and only move
+    to the protected LRU when touched again, so a single scan can not flush
+    the hot set. Probation is evicted first once it holds more than `kin`
+    of the cached bytes.
+    '''
+
+    def __init__(self, kin=0.25):
+        self.kin = kin
+        self.probation = collections.OrderedDict()
+        self.protected = collections.OrderedDict()
+        self.sizes = dict(probation=0, protected=0)
+
+    def __len__(self):
+        return len(self.probation) + len(self.protected)
+
+    def __contains__(self, k):
+        return k in self.probation or k in self.protected
+
+    def get(self, k, default=None):
+        if k in self.protected:
+            return self.protected[k]
+        return self.probation.get(k, default)
+
+    def items(self):
+        return list(self.probation.items()) + list(self.protected.items())
+
+    def values(self):
+        return [size for _, size in self.items()]
+
+    def add(self, name, k, size):
+        getattr(self, name)[k] = size
+        self.sizes[name] += size
+
+    def remove(self, name, k):
+        size = getattr(self, name).pop(k)
+        self.sizes[name] -= size
+        return size
+
+    def put(self, k, size):
+        if k in self.protected:
+            self.remove('protected', k)
+        elif k in self.probation:
+            self.remove('probation', k)
+        else:
+            self.add('probation', k, size)
+            return
+        self.add('protected', k, size)
+
+    def pop(self, k, default=None):
+        if k in self.protected:
+            return self.remove('protected', k)
+        if k in self.probation:
+            return self.remove('probation', k)
+        return default
+
+    def touch(self, k):
+        if k in self.protected:
+            self.protected.move_to_end(k)
+        elif k in self.probation:
+            self.add('protected', k, self.remove('probation', k))
+
+    def victim(self):
+        probation = self.sizes['probation']
+        name = 'protected'
+        if self.probation and (not self.protected or
+                               probation > (probation + self.sizes['protected']) * self.kin):
+            name = 'probation'
+        k = next(iter(getattr(self, name)))
+        return k, self.remove(name, k)
+
+
+class GDSF(LRU):
+    '''
+    Greedy-Dual-Size-Frequency, evicts the entry with the lowest
+    inflation + frequency / size, so small and often used files stay.
+    '''
+
+    def __init__(self):
+        self.entries = dict()  # key: entry, value: [size, frequency, priority]
+        self.heap = []
+        self.inflation = 0.0
+        self.counter = itertools.count()
+
+    def items(self):
+        ordered = sorted(self.entries.items(), key=lambda item: item[1][2])
+        return [(k, entry[0]) for k, entry in ordered]
+
+    def copy(self):
+        return collections.OrderedDict(self.items())
+
+    def get(self, k, default=None):
+        entry = self.entries.get(k)
+        return default if entry is None else entry[0]
+
+    def push(self, k, entry):
+        entry[2] = self.inflation + entry[1] / max(entry[0], 1)
+        heapq.heappush(self.heap, (entry[2], next(self.counter), k))
+        if len(self.heap) > 4 * len(self.entries) + 64:
+            self.heap = [(e[2], next(self.counter), key)
+                         for key, e in self.entries.items()]
+            heapq.heapify(self.heap)
+
+    def put(self, k, size):
+        entry = self.entries.get(k)
+        if entry is None:
+            entry = [size, 0, 0.0]
+            self.entries[k] = entry
+        entry[0] = size
+        entry[1] += 1
+        self.push(k, entry)
+
+    def pop(self, k, default=None):
+        entry = self.entries.pop(k, None)
+        return default if entry is None else entry[0]
+
+    def touch(self, k):
+        entry = self.entries.get(k)
+        if entry is not None:
+            entry[1] += 1
+            self.push(k, entry)
+
+    def victim(self):
+        while True:
+            priority, _, k = heapq.heappop(self.heap)
+            entry = self.entries.get(k)
+            # skip heap items left behind by later touches
+            if entry is not None and entry[2] == priority:
+                del self.entries[k]
+                self.inflation = priority
+                return k, entry[0]
+
+
+POLICIES = {'lru': LRU, '2q': TwoQ, 'gdsf': GDSF}
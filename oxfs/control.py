@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+import logging
+import os
+import stat
+import threading
+import time
+
+from errno import EACCES, EINVAL, ENOENT, ENOTDIR
+from fuse import FuseOSError, Operations
+
+CONTROL = '/.oxfs'
+
+
+class Control(Operations):
+    '''
+    The /.oxfs directory of the mount, nothing under it reaches the remote.
+    Its files are rendered by the functions in `files`, the content a
+    lookup sized a file by is the content the following open serves. The
+    lines written to a file of `commands` are passed to its function, a
+    ValueError fails the write with EINVAL.
+    '''
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.files = dict()  # key: name, value: function returning bytes
+        self.commands = dict()  # key: name, value: function called with each line
+        self.lock = threading.Lock()
+        self.rendered = dict()  # key: path, value: content of its last lookup
+        self.contents = dict()  # key: file handle, value: content
+        self.pending = dict()  # key: file handle, value: a partial line written
+        self.fh = 0
+
+    @staticmethod
+    def owns(path):
+        return path is not None and (path == CONTROL or path.startswith(CONTROL + '/'))
+
+    @staticmethod
+    def name(path):
+        return path[len(CONTROL) + 1:]
+
+    def render(self, path):
+        name = self.name(path)
+        render = self.files.get(name)
+        if render is None:
+            if name not in self.commands:
+                raise FuseOSError(ENOENT)
+            return b''
+        return render()
+
+    def getattr(self, path, fh=None):
+        now = time.time()
+        attr = dict(st_atime=now, st_mtime=now, st_ctime=now,
+                    st_uid=os.getuid(), st_gid=os.getgid())
+        if CONTROL == path:
+            attr.update(st_mode=stat.S_IFDIR | 0o555, st_size=0, st_nlink=2)
+            return attr
+        data = self.render(path)
+        with self.lock:
+            self.rendered[path] = data
+        mode = 0o644 if self.name(path) in self.commands else 0o444
+        attr.update(st_mode=stat.S_IFREG | mode, st_size=len(data), st_nlink=1)
+        return attr
+
+    def readdir(self, path, fh=None):
+        if CONTROL != path:
+            raise FuseOSError(ENOTDIR)
+        return sorted(set(self.files) | set(self.commands)) + ['.', '..']
+
+    def open(self, path, flags):
+        if flags & (os.O_WRONLY | os.O_RDWR) and self.name(path) not in self.commands:
+            raise FuseOSError(EACCES)
+        with self.lock:
+            data = self.rendered.pop(path, None)
+        if data is None:
+            data = self.render(path)
+        with self.lock:
+            self.fh += 1
+            self.contents[self.fh] = data
+            return self.fh
+
+    def read(self, path, size, offset, fh):
+        return self.contents[fh][offset:offset + size]
+
+    def truncate(self, path, length, fh=None):
+        # `echo command > file` truncates first
+        if self.name(path) not in self.commands:
+            raise FuseOSError(EACCES)
+        return 0
+
+    def write(self, path, data, offset, fh):
+        command = self.commands.get(self.name(path))
+        if command is None:
+            raise FuseOSError(EACCES)
+        with self.lock:
+            lines = (self.pending.pop(fh, b'') + data).split(b'\n')
+            self.pending[fh] = lines.pop()
+        for line in lines:
+            self.execute(command, line)
+        return len(data)
+
+    def execute(self, command, line):
+        line = line.decode('utf-8').strip()
+        if not line:
+            return
+        try:
+            command(line)
+        except ValueError as e:
+            self.logger.error('{}, {}'.format(line, e))
+            raise FuseOSError(EINVAL)
+
+    def release(self, path, fh):
+        with self.lock:
+            self.contents.pop(fh, None)
+            line = self.pending.pop(fh, b'')
+        command = self.commands.get(self.name(path))
+        if command is not None and line:
+            try:
+                self.execute(command, line)
+            except FuseOSError:
+                pass
+        return 0
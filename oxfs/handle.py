@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+import collections
+import itertools
+import logging
+import os
+import threading
+
+
+class Handle:
+    def __init__(self, path, flags):
+        self.path = path
+        self.mode = 'rb+' if flags & (os.O_WRONLY | os.O_RDWR) else 'rb'
+        self.lock = threading.Lock()
+        self.localfile = None
+        self.local = None
+        self.stale = False
+        self.closed = False
+        # key: sftp channel, value: SFTPFile opened on it
+        self.remotes = dict()
+        # cache keys already referenced through this handle
+        self.referenced = set()
+
+    def localfd(self, name):
+        if self.local is not None and self.localfile == name and not self.stale:
+            return self.local
+        self.close_local()
+        self.local = os.open(name, os.O_RDWR)
+        self.localfile = name
+        self.stale = False
+        return self.local
+
+    def close_local(self):
+        if self.local is not None:
+            os.close(self.local)
+            self.local = None
+
+
+class HandleTable:
+    '''
+    Open FUSE file handles, each keeps its local cache fd and remote files
+    alive until release. A sftp channel must only be used by the thread that
+    leased it, so remote files are kept per channel and closed by the next
+    thread holding that channel.
+    '''
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.lock = threading.Lock()
+        self.handles = dict()
+        self.counter = itertools.count(1)
+        self.closing = collections.defaultdict(list)
+
+    def open(self, path, flags):
+        fh = next(self.counter)
+        with self.lock:
+            self.handles[fh] = Handle(path, flags)
+        return fh
+
+    def get(self, fh):
+        with self.lock:
+            return self.handles.get(fh)
+
+    def adopt(self, fh, sftp, remote):
+        handle = self.get(fh)
+        with handle.lock:
+            handle.remotes[sftp] = remote
+
+    def release(self, fh, sftp=None):
+        '''
+        Remote files on `sftp`, the channel held by the caller, are closed
+        now, the others when their channel is leased again.
+        '''
+        with self.lock:
+            handle = self.handles.pop(fh, None)
+        if handle is None:
+            return
+        with handle.lock:
+            handle.closed = True
+            handle.close_local()
+            remotes, handle.remotes = handle.remotes, dict()
+        for owner, remote in remotes.items():
+            if owner is sftp:
+                self.close(remote)
+                continue
+            with self.lock:
+                self.closing[owner].append(remote)
+
+    def reap(self, sftp):
+        # close the remote files released on a channel we just leased
+        with self.lock:
+            remotes = self.closing.pop(sftp, None)
+        for remote in remotes or []:
+            self.close(remote)
+
+    def forget(self, sftp):
+        # a closed channel took its remote files along
+        with self.lock:
+            self.closing.pop(sftp, None)
+
+    def close(self, remote):
+        try:
+            remote.close()
+        except Exception as e:
+            self.logger.debug(e)
+
+    def invalidate(self, name):
+        with self.lock:
+            handles = list(self.handles.values())
+        for handle in handles:
+            if handle.localfile == name:
+                handle.stale = True
+
+    def opened(self, path):
+        with self.lock:
+            return any(handle.path == path for handle in self.handles.values())
+
+    def reference(self, fh, keys):
+        '''
+        Returns the cache keys not referenced through `fh` yet, the reads of
+        one open count as a single reference.
+        '''
+        handle = self.get(fh)
+        if handle is None:
+            return list(keys)
+        with handle.lock:
+            fresh = [k for k in keys if k not in handle.referenced]
+            handle.referenced.update(fresh)
+        return fresh
+
+    def cached(self, fh, name):
+        handle = self.get(fh)
+        if handle is None:
+            return False
+        return handle.local is not None and handle.localfile == name and not handle.stale
+
+    def pread(self, fh, name, size, offset):
+        '''
+        Returns None if `name` does not exist.
+        '''
+        handle = self.get(fh)
+        try:
+            if handle is None:
+                fd = os.open(name, os.O_RDONLY)
+                try:
+                    return os.pread(fd, size, offset)
+                finally:
+                    os.close(fd)
+            with handle.lock:
+                return os.pread(handle.localfd(name), size, offset)
+        except FileNotFoundError:
+            return None
+
+    def pwrite(self, fh, name, data, offset):
+        handle = self.get(fh)
+        if handle is None:
+            fd = os.open(name, os.O_WRONLY)
+            try:
+                return os.pwrite(fd, data, offset)
+            finally:
+                os.close(fd)
+        with handle.lock:
+            return os.pwrite(handle.localfd(name), data, offset)
+
+    def remote(self, fh, sftp, path):
+        '''
+        Returns the remote file of `fh` on `sftp`, the channel held by the
+        caller, opened on first use, or None if `fh` is not an open handle.
+        '''
+        handle = self.get(fh)
+        if handle is None:
+            return None
+        remote = handle.remotes.get(sftp)
+        if remote is not None:
+            return remote
+
+        remote = sftp.open(path, handle.mode)
+        with handle.lock:
+            if not handle.closed:
+                handle.remotes[sftp] = remote
+                return remote
+        with self.lock:
+            self.closing[sftp].append(remote)
+        return remote
@@ -4,21 +4,135 @@ import threading
 import xxhash
 
 
+class RWLock:
+    '''
+    Readers share the lock, a writer holds it alone and waiting writers
+    keep new readers out so they are not starved.
+    '''
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.writers = 0  # waiting
+        self.refs = 0  # holders and waiters, the lock is freed at 0
+
+    def acquire(self, shared, blocking=True):
+        '''
+        Returns (acquired, waited).
+        '''
+        with self.cond:
+            waited = False
+            if not shared:
+                self.writers += 1
+            try:
+                while self.writer or (self.readers if not shared else self.writers):
+                    if not blocking:
+                        return False, waited
+                    waited = True
+                    self.cond.wait()
+            finally:
+                if not shared:
+                    self.writers -= 1
+            if shared:
+                self.readers += 1
+            else:
+                self.writer = True
+            return True, waited
+
+    def release(self, shared):
+        with self.cond:
+            if shared:
+                self.readers -= 1
+            else:
+                self.writer = False
+            self.cond.notify_all()
+
+    def locked(self):
+        return self.writer or self.readers > 0
+
+
 class Lock:
-    def __init__(self, max_locks=2048):
-        self.locks = [threading.Lock() for _ in range(0, max_locks)]
+    '''
+    Per path reader-writer locks, created on first use and freed once no
+    thread holds or waits for them. Past `max_paths` live locks new paths
+    share `stripes` hashed locks instead, a path keeps the lock it started
+    with until it is idle again.
+    '''
+
+    def __init__(self, max_paths=2**16, stripes=2048):
+        self.mutex = threading.Lock()
+        self.max_paths = max_paths
+        self.paths = dict()
+        self.stripes = [RWLock() for _ in range(0, stripes)]
+        self.striped = dict()  # key: path on a stripe, value: references
+        self.stats = dict(acquired=0, contended=0, failed=0, striped=0)
 
     def lockid(self, path):
-        return xxhash.xxh64_intdigest(path) % len(self.locks)
+        return xxhash.xxh64_intdigest(path) % len(self.stripes)
+
+    def get(self, path):
+        with self.mutex:
+            lock = self.paths.get(path)
+            if lock is None and path not in self.striped and len(self.paths) < self.max_paths:
+                lock = RWLock()
+                self.paths[path] = lock
+            if lock is not None:
+                lock.refs += 1
+                return lock
+            self.striped[path] = self.striped.get(path, 0) + 1
+            self.stats['striped'] += 1
+            return self.stripes[self.lockid(path)]
+
+    def put(self, path, shared=None):
+        # releases the lock if `shared` is given, then drops the reference
+        with self.mutex:
+            lock = self.paths.get(path)
+            if lock is not None:
+                if shared is not None:
+                    lock.release(shared)
+                lock.refs -= 1
+                if not lock.refs:
+                    del self.paths[path]
+                return
+            if shared is not None:
+                self.stripes[self.lockid(path)].release(shared)
+            refs = self.striped.pop(path) - 1
+            if refs:
+                self.striped[path] = refs
+
+    def acquire(self, path, shared, blocking=True):
+        acquired, waited = self.get(path).acquire(shared, blocking)
+        if acquired:
+            self.stats['acquired'] += 1
+            if waited:
+                self.stats['contended'] += 1
+        else:
+            self.stats['failed'] += 1
+            self.put(path)
+        return acquired
 
     def lock(self, path):
-        self.locks[self.lockid(path)].acquire()
+        self.acquire(path, False)
 
     def unlock(self, path):
-        self.locks[self.lockid(path)].release()
+        self.put(path, False)
 
     def trylock(self, path):
-        return self.locks[self.lockid(path)].acquire(False)
+        return self.acquire(path, False, False)
+
+    def rlock(self, path):
+        self.acquire(path, True)
+
+    def runlock(self, path):
+        self.put(path, True)
+
+    def tryrlock(self, path):
+        return self.acquire(path, True, False)
 
     def locked(self, path):
-        return self.locks[self.lockid(path)].locked()
+        with self.mutex:
+            lock = self.paths.get(path)
+            if lock is None and path in self.striped:
+                lock = self.stripes[self.lockid(path)]
+            return lock is not None and lock.locked()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+import bisect
+import http.server
+import json
+import logging
+import threading
+import time
+
+# upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def quantile(counts, q):
+    '''
+    Upper bound in seconds of the bucket holding the `q` quantile, the top
+    bound for the overflow bucket, as json has no infinity.
+    '''
+    total = sum(counts)
+    if not total:
+        return None
+    rank, seen = q * total, 0
+    for i, n in enumerate(counts):
+        seen += n
+        if seen >= rank:
+            return BUCKETS[min(i, len(BUCKETS) - 1)]
+
+
+class Metrics:
+    '''
+    Counts and latency histograms of the fuse operations, split into the
+    ones served from the cache and the ones that sent remote requests, and
+    counters of the bytes moved. Nothing is recorded unless `enabled`. The
+    gauges of `sources` are only read when a report is made.
+    '''
+
+    def __init__(self, enabled=False):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.enabled = enabled
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.ops = dict()  # key: (op, source), value: [count, seconds, requests, buckets]
+        self.counters = dict()
+        self.sources = dict()  # key: name, value: function returning {gauge: value}
+        self.server = None
+
+    def observe(self, op, requests, seconds):
+        key = (op, 'remote' if requests else 'cache')
+        i = bisect.bisect_left(BUCKETS, seconds)
+        with self.lock:
+            entry = self.ops.get(key)
+            if entry is None:
+                entry = self.ops[key] = [0, 0.0, 0, [0] * (len(BUCKETS) + 1)]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] += requests
+            entry[3][i] += 1
+
+    def add(self, name, n=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        with self.lock:
+            ops = dict((key, entry[:3] + [list(entry[3])]) for key, entry in self.ops.items())
+            counters = dict(self.counters)
+        gauges = dict()
+        for name, source in self.sources.items():
+            try:
+                gauges[name] = source()
+            except Exception as e:
+                self.logger.debug('{} gauges failed, {}'.format(name, e))
+        return ops, counters, gauges
+
+    def json(self):
+        ops, counters, gauges = self.snapshot()
+        report = dict(enabled=self.enabled, uptime=time.time() - self.started,
+                      ops=dict(), counters=counters, **gauges)
+        for (op, source), (count, seconds, requests, buckets) in sorted(ops.items()):
+            p50, p99 = quantile(buckets, 0.5), quantile(buckets, 0.99)
+            report['ops'].setdefault(op, dict())[source] = dict(
+                count=count, seconds=seconds, requests=requests,
+                p50_ms=p50 * 1000, p99_ms=p99 * 1000)
+        return json.dumps(report, indent=2, sort_keys=True) + '\n'
+
+    def prometheus(self):
+        ops, counters, gauges = self.snapshot()
+        lines = ['# TYPE oxfs_op_seconds histogram']
+        for (op, source), (count, seconds, requests, buckets) in sorted(ops.items()):
+            labels = 'op="{}",source="{}"'.format(op, source)
+            cumulative = 0
+            for bound, n in zip(BUCKETS + ('+Inf',), buckets):
+                cumulative += n
+                lines.append('oxfs_op_seconds_bucket{{{},le="{}"}} {}'.format(labels, bound, cumulative))
+            lines.append('oxfs_op_seconds_sum{{{}}} {}'.format(labels, seconds))
+            lines.append('oxfs_op_seconds_count{{{}}} {}'.format(labels, count))
+        lines.append('# TYPE oxfs_op_requests_total counter')
+        for (op, source), (_, _, requests, _) in sorted(ops.items()):
+            lines.append('oxfs_op_requests_total{{op="{}",source="{}"}} {}'.format(op, source, requests))
+        for name, value in sorted(counters.items()):
+            lines.append('# TYPE oxfs_{}_total counter'.format(name))
+            lines.append('oxfs_{}_total {}'.format(name, value))
+        for group, values in sorted(gauges.items()):
+            for name, value in sorted(values.items()):
+                lines.append('oxfs_{}_{} {}'.format(group, name, value))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port):
+        '''
+        Serves the prometheus text at http://127.0.0.1:`port`/metrics.
+        '''
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.server.metrics = self
+        thread = threading.Thread(target=self.server.serve_forever, args=())
+        thread.daemon = True
+        thread.name = 'metrics'
+        thread.start()
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        data = self.server.metrics.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
@@ -2,23 +2,40 @@
 
 import argparse
 import getpass
+import json
 import logging
 import multiprocessing
 import os
 import threading
 import paramiko
 import platform
+import stat
 import subprocess
 import sys
+import time
 
 from concurrent.futures import ThreadPoolExecutor
 from errno import ENOENT
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
 
+from oxfs.backend.local import LocalBackend
+from oxfs.backend.sftp import SFTPBackend
+from oxfs.cache.digest import remote_digest
 from oxfs.cache.fs import CacheManager
-from oxfs.cache.meta import Cache
+from oxfs.cache.meta import METADB, Cache, MetaStore
+from oxfs.cache.policy import POLICIES
+from oxfs.control import Control
+from oxfs.handle import HandleTable
 from oxfs.lock import Lock as Mutex
+from oxfs.metrics import Metrics
+from oxfs.pool import ChannelPool
+from oxfs.readahead import ReadAhead
+from oxfs.remotecopy import RemoteCopy, main as copy_main
+from oxfs.transfer import Transfer
 from oxfs.updater import CacheUpdater
+from oxfs.warmup import WarmUp, main as warmup_main
+from oxfs.watcher import Watcher
+from oxfs.writeback import WriteBack
 
 BACKGROUND = 'BACKGROUND'
 
@@ -30,7 +47,9 @@ class Oxfs(LoggingMixIn, Operations):
     You need to be able to login to remote host without entering a password.
     '''
 
-    def __init__(self, host, user, cache_path, remote_path, port=22, key_filename=None):
+    def __init__(self, host, user, cache_path, remote_path, port=22, key_filename=None, readahead=8,
+                 cache_options=None, ttls=None, lock_stripes=2048, pool_options=None,
+                 transfer_options=None, backend=None, metrics=False, compress=False):
         self.logger = logging.getLogger(__class__.__name__)
         self.sys = platform.system()
         self.host = host
@@ -38,24 +57,104 @@ class Oxfs(LoggingMixIn, Operations):
         self.user = user
         self.password = None
         self.key_filename = key_filename
+        self.compress = compress
         self.cache_path = cache_path
         self.remote_path = os.path.normpath(remote_path)
-        self.client, self.sftp = self.open_sftp()
-        self.attributes = Cache()
-        self.directories = Cache()
-        self.manager = CacheManager(self.cache_path)
-        self.mtx = Mutex()
+        self.local = threading.local()
+        self.metrics = Metrics(metrics)
+        self.control = Control()
+        self.pool = ChannelPool(backend or SFTPBackend(self.open_client), **(pool_options or {}))
+        # log in now, a daemon gets the password before it detaches
+        self.pool.release(self.pool.acquire())
+        self.store = None
+        self.watcher = None
+        self.ttls = dict(attr=60, dir=60, negative=10)
+        self.ttls.update(ttls or {})
+        self.attributes = Cache(ttl=self.ttl)
+        self.directories = Cache(ttl=lambda entries: self.ttls['dir'])
+        options = dict(cache_options or {})
+        options['pinned'] = [self.remotepath(os.path.join('/', prefix))
+                             for prefix in options.get('pinned', ())]
+        self.manager = CacheManager(self.cache_path, **options)
+        self.readahead = ReadAhead(self.manager.blocksize, readahead)
+        self.handles = HandleTable()
+        self.writeback = WriteBack(self._flush)
+        self.manager.listeners.append(self.handles.invalidate)
+        self.pool.listeners.append(self.handles.forget)
+        self.transfer = Transfer(self.pool, **(transfer_options or {}))
+        self.mtx = Mutex(stripes=lock_stripes)
+        self.warmup = WarmUp(self)
+        self.control.files['warmup'] = lambda: (json.dumps(
+            self.warmup.status(), indent=2, sort_keys=True) + '\n').encode('utf-8')
+        self.control.commands['warmup'] = self.warmup.command
+        self.copier = RemoteCopy(self)
+        self.control.files['copy'] = lambda: (json.dumps(
+            self.copier.status(), indent=2, sort_keys=True) + '\n').encode('utf-8')
+        self.control.commands['copy'] = self.copier.command
+        self.control.files['stats'] = lambda: self.metrics.json().encode('utf-8')
+        self.control.files['metrics'] = lambda: self.metrics.prometheus().encode('utf-8')
+        self.metrics.sources.update(
+            pool=self.pool.counts,
+            locks=lambda: dict(self.mtx.stats, paths=len(self.mtx.paths)),
+            transfer=lambda: dict(self.transfer.stats, running=len(self.transfer.status())),
+            cache=lambda: dict(bytes=self.manager.usage(), files=self.manager.files,
+                               compressed=len(self.manager.compressed),
+                               objects=len(self.manager.objects),
+                               shared_bytes=self.manager.shared,
+                               attributes=len(self.attributes.cache),
+                               directories=len(self.directories.cache),
+                               dirty_bytes=self.writeback.dirty()),
+            warmup=lambda: dict(queued=self.warmup.queue.qsize(), trees=len(self.warmup.trees)),
+            copy=lambda: dict(self.copier.stats))
+        link = getattr(self.pool.backend, 'link', None)
+        if link is not None:
+            self.metrics.sources['wire'] = lambda: dict(link.stats)
+
+    def ttl(self, attr):
+        if self.watcher is not None and self.watcher.active:
+            # change events invalidate entries, they need no lifetime
+            return None
+        if ENOENT == attr:
+            return self.ttls['negative']
+        if stat.S_ISDIR(attr['st_mode']):
+            return self.ttls['dir']
+        return self.ttls['attr']
 
     def start_thread_pool(self, parallel):
-        self.tls = dict()
         self.taskpool = ThreadPoolExecutor(
             max_workers=parallel, thread_name_prefix='oxfs-pool')
+        self.metrics.sources['taskpool'] = lambda: dict(
+            queued=self.taskpool._work_queue.qsize(), threads=len(self.taskpool._threads))
+
+    def start_write_back(self, config):
+        self.writeback.interval = config.writeback_interval
+        self.writeback.run(self.submit)
 
     def start_cache_updater(self, config):
-        self.updater = CacheUpdater(self, config.cache_timeout)
+        self.updater = CacheUpdater(self, config.cache_timeout,
+                                    config.refresh_workers, config.refresh_rate)
+        self.metrics.sources['updater'] = lambda: dict(self.updater.stats)
+        self.manager.run(config.cache_timeout)
         if config.auto_cache:
+            # entries kept across mounts are only safe to serve when revalidated
+            self.store = MetaStore(os.path.join(self.cache_path, METADB))
+            self.attributes.attach(self.store, 'attr')
+            self.directories.attach(self.store, 'dir')
             self.updater.run()
 
+    def start_watcher(self, config):
+        if config.watch:
+            self.watcher = Watcher(self, config.watch_command)
+            self.watcher.run()
+
+    def start_warmup(self, config):
+        self.warmup.workers = config.warmup_workers
+        self.warmup.run()
+
+    def start_metrics(self, config):
+        if config.metrics_port:
+            self.metrics.serve(config.metrics_port)
+
     def spawnvpe(self):
         a, e = sys.argv, os.environ
         a.remove('--daemon')
@@ -84,46 +183,101 @@ class Oxfs(LoggingMixIn, Operations):
         try:
             # https://stackoverflow.com/questions/70565357/paramiko-authentication-fails-with-agreed-upon-rsa-sha2-512-pubkey-algorithm
             client.connect(self.host, port=self.port, disabled_algorithms=dict(pubkeys=["rsa-sha2-512", "rsa-sha2-256"]),
-                           username=self.user, password=password, key_filename=self.key_filename)
-            return client.open_sftp()
+                           username=self.user, password=password, key_filename=self.key_filename,
+                           compress=self.compress)
+            return True
         except paramiko.ssh_exception.SSHException as e:
             if abort_on_failed:
                 print('Permission denied.')
                 self.logger.exception(e)
                 sys.exit(1)
 
-    def open_sftp(self):
+    def open_client(self):
         client = paramiko.SSHClient()
         client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         client.load_system_host_keys()
 
         if self.key_filename:
             prompt = '''{}'s password: '''.format(self.key_filename)
-            return client, self.try_connect(client, self.getpass(prompt), True)
+            self.try_connect(client, self.getpass(prompt), True)
+            return client
 
-        if not self.password:
-            sftp = self.try_connect(client, None, False)
-            if sftp:
-                return client, sftp
+        if not self.password and self.try_connect(client, None, False):
+            return client
 
         prompt = '''{}@{}'s password: '''.format(self.user, self.host)
-        return client, self.try_connect(client, self.getpass(prompt), True)
+        self.try_connect(client, self.getpass(prompt), True)
+        return client
+
+    def channel(self):
+        '''
+        Returns the sftp channel leased by the current fuse callback or
+        task, leased from the pool on first use. A fuse callback does not
+        wait for a busy pool, it gets an extra channel at once.
+        '''
+        sftp = getattr(self.local, 'sftp', None)
+        if sftp is None:
+            sftp = self.pool.acquire(0 if getattr(self.local, 'foreground', False) else None)
+            self.handles.reap(sftp)
+            self.local.sftp = sftp
+            self.local.requests = getattr(sftp, 'requests', 0)
+        return sftp
+
+    def leased(self):
+        return getattr(self.local, 'sftp', None)
 
-    def current_thread_sftp(self):
-        tid = threading.get_ident()
-        curr = self.tls.get(tid)
-        if curr is None:
-            curr = dict()
-            self.tls[tid] = curr
+    def requests(self):
+        # remote requests sent since the channel of this thread was leased
+        sftp = self.leased()
+        if sftp is None:
+            return 0
+        return getattr(sftp, 'requests', 0) - self.local.requests
 
-        sftp = curr.get('sftp')
+    def release_channel(self):
+        sftp = getattr(self.local, 'sftp', None)
         if sftp is not None:
-            return sftp
+            self.local.sftp = None
+            self.pool.release(sftp)
 
-        client, sftp = self.open_sftp()
-        curr['sftp'] = sftp
-        curr['client'] = client
-        return sftp
+    def background(self, fn, *args):
+        try:
+            return fn(*args)
+        finally:
+            if self.metrics.enabled:
+                self.metrics.add('background_requests', self.requests())
+            self.release_channel()
+
+    def submit(self, fn, *args):
+        # a task holds its channel only while it runs
+        return self.taskpool.submit(self.background, fn, *args)
+
+    def __call__(self, op, *args):
+        # fuse threads only run callbacks
+        self.local.foreground = True
+        if args and (self.control.owns(args[0]) or
+                     op in ('rename', 'link') and self.control.owns(args[1])):
+            try:
+                return self.control(op, *args)
+            finally:
+                # a command may have leased a channel
+                self.release_channel()
+        if not self.metrics.enabled:
+            try:
+                return super().__call__(op, *args)
+            finally:
+                self.release_channel()
+
+        started = time.perf_counter()
+        result = None
+        try:
+            result = super().__call__(op, *args)
+            return result
+        finally:
+            requests = self.requests()
+            self.release_channel()
+            self.metrics.observe(op, requests, time.perf_counter() - started)
+            if 'read' == op and result is not None:
+                self.metrics.add('read_remote_bytes' if requests else 'read_cache_bytes', len(result))
 
     def cachefile(self, path, renew=True):
         key = self.manager.cachefile(path)
@@ -131,29 +285,185 @@ class Oxfs(LoggingMixIn, Operations):
             self.manager.renew(key)
         return key
 
+    def renew(self, fh, keys):
+        # a sequential pass reads a block in several calls, counting each as
+        # reuse would promote every block of a scan
+        for key in self.handles.reference(fh, keys):
+            self.manager.renew(key)
+
     def remotepath(self, path):
         return os.path.normpath(os.path.join(self.remote_path, path[1:]))
 
-    def syncfile(self, sftp, path):
+    def syncfile(self, sftp, path, ahead=False):
         cachefile = self.cachefile(path, False)
+        self.settle(sftp, path)
         st = sftp.lstat(path)
-        if st.st_size > self.manager.maxsize:
+        if st.st_size > self.manager.syncsize:
             return False
 
+        validator = [st.st_mtime, st.st_size]
+        digest = self.remotedigest(sftp, path, st.st_size)
+        if digest is not None and self.manager.clone(digest, cachefile, path, validator):
+            self.logger.info('syncfile {} from an identical cached file'.format(path))
+            self.metrics.add('dedup_bytes', st.st_size)
+            return True
+
         self.logger.info('syncfile {}'.format(path))
         tmpfile = cachefile + '.tmpfile'
-        sftp.get(path, tmpfile)
+        if self.transfer.parallel(st.st_size):
+            self.transfer.download(path, tmpfile, st.st_size)
+        else:
+            sftp.get(path, tmpfile)
+        self.metrics.add('download_bytes', st.st_size)
+        # only files fetched ahead of use, the others are written next
+        packed = ahead and self.manager.pack(tmpfile)
         os.rename(tmpfile, cachefile)
-        self.manager.put(cachefile)
+        self.manager.put(cachefile, path, validator, packed)
+        if ahead:
+            self.manager.intern(cachefile, digest)
         return True
 
+    def remotedigest(self, sftp, path, size):
+        # worth a remote command for files of a block or more, the others
+        # are hashed once downloaded
+        if not self.manager.dedup or size < self.manager.blocksize:
+            return None
+        return remote_digest(self.pool.client(sftp), path)
+
     def _getfile(self, path):
         if self.mtx.trylock(path):
             cachefile = self.cachefile(path, False)
-            if not os.path.exists(cachefile):
-                self.syncfile(self.current_thread_sftp(), path)
+            # partial files are filled by read-ahead, not downloaded twice
+            if not os.path.exists(cachefile) and self.manager.blockmap(cachefile) is None:
+                self.syncfile(self.channel(), path, True)
+            self.mtx.unlock(path)
+
+    def filesize(self, sftp, path):
+        attr = self.attributes.get(path)
+        if type(attr) != dict:
+            attr = self.extract(sftp.lstat(path))
+        return attr['st_size']
+
+    def partial(self, cachefile, filesize):
+        if self.manager.blockmap(cachefile) is not None:
+            return True
+        return filesize > self.manager.syncsize
+
+    def fetchblocks(self, sftp, path, indexes):
+        bs = self.manager.blocksize
+        self.settle(sftp, path)
+        with sftp.open(path, 'rb') as infile:
+            remote = infile.stat().st_size
+            chunks = [(i * bs, min(bs, remote - i * bs))
+                      for i in indexes if i * bs < remote]
+            if not chunks:
+                return remote, []
+            self.logger.info('fetch {} blocks of {}'.format(len(chunks), path))
+            chunks = [(start, data) for (start, _), data in zip(chunks, infile.readv(chunks))]
+            self.metrics.add('download_bytes', sum(len(data) for _, data in chunks))
+            return remote, chunks
+
+    def storeblocks(self, cachefile, remote, chunks):
+        # never overwrite a block that became present meanwhile, it may hold local writes
+        bs = self.manager.blocksize
+        blocks = self.manager.blockmap(cachefile, remote)
+        stored = []
+        fd = os.open(self.manager.partfile(cachefile), os.O_WRONLY)
+        try:
+            for start, data in chunks:
+                if not blocks.test(start // bs):
+                    os.pwrite(fd, data, start)
+                    stored.append(start // bs)
+        finally:
+            os.close(fd)
+        return stored
+
+    def fillblocks(self, sftp, path, cachefile, offset, size, overwrite=False, fh=None):
+        '''
+        Makes the blocks covering [offset, offset + size) of a partially cached
+        file present, returns the local file to serve them from. Blocks fully
+        covered by a write are not fetched when `overwrite` is set.
+        '''
+        if os.path.exists(cachefile):
+            return cachefile
+
+        bs = self.manager.blocksize
+        indexes = range(offset // bs, (offset + max(size, 1) - 1) // bs + 1)
+        blocks = self.manager.blockmap(cachefile)
+        missing = [i for i in indexes if blocks is None or not blocks.test(i)]
+        if overwrite:
+            missing = [i for i in missing
+                       if i * bs < offset or (i + 1) * bs > offset + size]
+
+        stored = []
+        if blocks is None or missing:
+            remote, chunks = self.fetchblocks(sftp, path, missing)
+            stored = self.storeblocks(cachefile, remote, chunks)
+        if overwrite:
+            stored = indexes
+        # the blocks in range are used now, before put_blocks evicts, storing
+        # a block is its first reference
+        self.handles.reference(fh, [(cachefile, i) for i in stored])
+        self.renew(fh, [(cachefile, i) for i in indexes])
+        if stored:
+            self.manager.put_blocks(cachefile, stored, path)
+            if self.manager.complete(cachefile):
+                self.completed(path)
+                return cachefile
+        return self.manager.partfile(cachefile)
+
+    def _readahead(self, path, cachefile, indexes):
+        blocks = self.manager.blockmap(cachefile)
+        if blocks is None:
+            return
+        missing = [i for i in indexes if not blocks.test(i)]
+        if not missing:
+            return
+        bs = self.manager.blocksize
+        held = self.manager.hold(cachefile, missing[0] * bs, (missing[-1] - missing[0] + 1) * bs)
+        try:
+            remote, chunks = self.fetchblocks(self.channel(), path, missing)
+            self.mtx.lock(path)
+            try:
+                # the file may have been dropped or completed while fetching
+                if self.manager.blockmap(cachefile) is None:
+                    return
+                stored = self.storeblocks(cachefile, remote, chunks)
+                if stored:
+                    self.manager.put_blocks(cachefile, stored, path)
+                    if self.manager.complete(cachefile):
+                        self.completed(path)
+            finally:
+                self.mtx.unlock(path)
+        finally:
+            self.manager.unhold(held)
+
+    def completed(self, path):
+        if self.manager.codec is not None or self.manager.dedup:
+            self.submit(self._compact, path)
+
+    def _compact(self, path):
+        # a file completed by blocks is stored like one fetched ahead of
+        # use, unless it holds writes not flushed yet
+        self.mtx.lock(path)
+        try:
+            cachefile = self.cachefile(path, False)
+            if not self.writeback.dirty(path) and os.path.exists(cachefile):
+                self.manager.compact(cachefile)
+        finally:
             self.mtx.unlock(path)
 
+    def listdir(self, sftp, path):
+        entries = []
+        for attr in sftp.listdir_attr(path):
+            entries.append(attr.filename)
+            child = os.path.join(path, attr.filename)
+            # keep entries already cached, they may carry unflushed local writes
+            if self.attributes.get(child) in (None, ENOENT):
+                self.attributes.put(child, self.extract(attr))
+        self.directories.put(path, entries)
+        return entries
+
     @staticmethod
     def extract(attr):
         return dict((key, getattr(attr, key)) for key in (
@@ -161,27 +471,31 @@ class Oxfs(LoggingMixIn, Operations):
 
     def chmod(self, path, mode):
         path = self.remotepath(path)
-        self.sftp.chmod(path, mode)
+        self.channel().chmod(path, mode)
         self.attributes.remove(path)
 
     def chown(self, path, uid, gid):
         path = self.remotepath(path)
         try:
-            self.sftp.chown(path, uid, gid)
+            self.channel().chown(path, uid, gid)
         except Exception as e:
             self.logger.error(e)
         self.attributes.remove(path)
 
-    def create(self, path, mode):
+    def create(self, path, mode, fi=None):
         path = self.remotepath(path)
         cachefile = self.cachefile(path, False)
         self.mtx.lock(path)
+        # the cache file may be linked to others, start a new one
+        self.manager.pop(cachefile)
         open(cachefile, 'wb').close()
-        self.sftp.open(path, 'wb').close()
+        fh = self.handles.open(path, os.O_RDWR)
+        sftp = self.channel()
+        self.handles.adopt(fh, sftp, sftp.open(path, 'wb+'))
         self.attributes.remove(path)
         self.directories.remove(os.path.dirname(path))
         self.mtx.unlock(path)
-        return 0
+        return fh
 
     def getattr(self, path, fh=None):
         path = self.remotepath(path)
@@ -191,76 +505,169 @@ class Oxfs(LoggingMixIn, Operations):
                 raise FuseOSError(ENOENT)
             return attr
 
+        sftp = self.channel()
+        self.settle(sftp, path)
+        old = self.attributes.peek(path)
         try:
-            attr = self.extract(self.sftp.lstat(path))
-            self.attributes.put(path, attr)
-            self.logger.debug('sftp getattr {}, attr {}'.format(path, attr))
-            return attr
+            attr = self.extract(sftp.lstat(path))
         except:
             self.attributes.put(path, ENOENT)
             raise FuseOSError(ENOENT)
 
+        self.attributes.put(path, attr)
+        self.logger.debug('sftp getattr {}, attr {}'.format(path, attr))
+        self.revalidate(path, old, attr)
+        return attr
+
+    def revalidate(self, path, old, attr):
+        # an expired entry changed remotely, drop the cached content too
+        if type(old) != dict or not stat.S_ISREG(attr['st_mode']):
+            return
+        if [old['st_mtime'], old['st_size']] == [attr['st_mtime'], attr['st_size']]:
+            return
+        cachefile = self.cachefile(path, False)
+        if self.manager.validator(cachefile) == [attr['st_mtime'], attr['st_size']]:
+            return
+        self.mtx.lock(path)
+        if not self.writeback.dirty(path):
+            self.manager.pop(cachefile)
+        self.mtx.unlock(path)
+
     def mkdir(self, path, mode):
         path = self.remotepath(path)
-        self.sftp.mkdir(path, mode)
+        self.channel().mkdir(path, mode)
         self.attributes.remove(path)
         self.directories.remove(os.path.dirname(path))
         return 0
 
+    def open(self, path, flags):
+        return self.handles.open(self.remotepath(path), flags)
+
     def read(self, path, size, offset, fh):
         path = self.remotepath(path)
-        cachefile = self.cachefile(path)
-        if self.mtx.trylock(path):
-            if os.path.exists(cachefile):
-                with open(cachefile, 'rb') as infile:
-                    infile.seek(offset, 0)
-                    readed = infile.read(size)
-                self.mtx.unlock(path)
+        cachefile = self.cachefile(path, False)
+        self.renew(fh, [cachefile])
+        # readers of a cached file share the lock, only a writer or a
+        # download of the same path sends them to the remote
+        if self.mtx.tryrlock(path):
+            try:
+                readed = self.readcache(fh, cachefile, cachefile, size, offset)
+            finally:
+                self.mtx.runlock(path)
+            if readed is not None:
                 return readed
-            self.mtx.unlock(path)
 
-        if not self.mtx.locked(path):
-            self.taskpool.submit(self._getfile, path)
+        sftp = self.channel()
+        filesize = self.filesize(sftp, path)
+        ahead = self.readahead.advise(path, offset, size, filesize)
+        if ahead is not None or self.partial(cachefile, filesize):
+            self.readahead.wait(path, offset, size)
+            self.mtx.lock(path)
+            held = self.manager.hold(cachefile, offset, size)
+            try:
+                datafile = self.fillblocks(sftp, path, cachefile, offset, size, fh=fh)
+                readed = self.readcache(fh, cachefile, datafile, size, offset)
+            finally:
+                self.manager.unhold(held)
+                self.mtx.unlock(path)
+            if ahead:
+                future = self.submit(
+                    self._readahead, path, cachefile, ahead)
+                self.readahead.submit(path, ahead, future)
+                # prefetched blocks are part of this pass
+                self.handles.reference(fh, [(cachefile, i) for i in ahead])
+            return readed
 
-        with self.sftp.open(path, 'rb') as infile:
-            infile.seek(offset, 0)
-            return infile.read(size)
+        if not self.mtx.locked(path):
+            self.submit(self._getfile, path)
+
+        self.settle(sftp, path)
+        infile = self.handles.remote(fh, sftp, path)
+        if infile is None:
+            with sftp.open(path, 'rb') as infile:
+                infile.seek(offset, 0)
+                return infile.read(size)
+        infile.seek(offset, 0)
+        return infile.read(size)
+
+    def readcache(self, fh, cachefile, datafile, size, offset):
+        # whole cache files may be compressed, their mappings decode them
+        if datafile == cachefile and (self.manager.mapped.maxfiles or
+                                      self.manager.iscompressed(cachefile)):
+            return self.manager.mapped.pread(cachefile, size, offset)
+        return self.handles.pread(fh, datafile, size, offset)
 
     def readdir(self, path, fh=None):
         path = self.remotepath(path)
         entries = self.directories.get(path)
         if entries is None:
-            entries = self.sftp.listdir(path)
-            self.directories.put(path, entries)
+            entries = self.listdir(self.channel(), path)
 
         return entries + ['.', '..']
 
     def readlink(self, path):
         path = self.remotepath(path)
-        return self.sftp.readlink(path)
+        return self.channel().readlink(path)
+
+    def flush(self, path, fh):
+        self.submit_flush(self.remotepath(path))
+        return 0
+
+    def fsync(self, path, datasync, fh):
+        self._flush(self.remotepath(path), self.channel())
+        return 0
+
+    def release(self, path, fh):
+        self.submit_flush(self.remotepath(path))
+        self.handles.release(fh, self.leased())
+        return 0
 
     def rename(self, old, new):
         old = self.remotepath(old)
         new = self.remotepath(new)
         self.logger.info('rename {} {}'.format(old, new))
-        self.sftp.rename(old, new)
-
-        self.mtx.lock(old)
-        self.manager.pop(self.cachefile(old, False))
-        self.attributes.remove(old)
-        self.directories.remove(os.path.dirname(old))
-        self.mtx.unlock(old)
-
-        self.mtx.lock(new)
-        self.manager.pop(self.cachefile(new, False))
-        self.attributes.remove(new)
-        self.directories.remove(os.path.dirname(new))
-        self.mtx.unlock(new)
+        sftp = self.channel()
+        # writes journaled below a renamed directory go out under their old names
+        for path in self.writeback.below(old):
+            self._flush(path, sftp)
+            self.writeback.discard(path)
+        journal = self.writeback.journal(new)
+        if journal is not None:
+            # a flush under way lands before the rename replaces its file
+            with journal.flushing:
+                self.writeback.discard(new)
+        # an editor saves by renaming a new file over the old one
+        sftp.posix_rename(old, new)
+        if old == new:
+            return 0
+
+        # the caches of the path and of everything below it move along,
+        # nothing is fetched again
+        for path in [old] + self.manager.below(old):
+            target = new + path[len(old):]
+            self.mtx.lock(path)
+            self.manager.move(self.cachefile(path, False), self.cachefile(target, False), target)
+            self.readahead.forget(path)
+            self.mtx.unlock(path)
+        self.attributes.move(old, new)
+        self.directories.move(old, new)
+        self.relist(os.path.dirname(old), remove=os.path.basename(old))
+        self.relist(os.path.dirname(new), add=os.path.basename(new))
         return 0
 
+    def relist(self, path, remove=None, add=None):
+        # edits a cached listing instead of listing it again
+        entries = self.directories.peek(path)
+        if entries is None:
+            return
+        entries = [name for name in entries if name != remove]
+        if add is not None and add not in entries:
+            entries.append(add)
+        self.directories.replace(path, entries)
+
     def rmdir(self, path):
         path = self.remotepath(path)
-        self.sftp.rmdir(path)
+        self.channel().rmdir(path)
         self.attributes.remove(path)
         self.directories.remove(os.path.dirname(path))
         return 0
@@ -269,7 +676,7 @@ class Oxfs(LoggingMixIn, Operations):
         target = self.remotepath(target)
         source = self.remotepath(source)
         # 'creates a symlink `target -> source` (e.g. ln -sf source target)'
-        self.sftp.symlink(source, target)
+        self.channel().symlink(source, target)
         self.attributes.remove(target)
         self.directories.remove(os.path.dirname(target))
         return 0
@@ -277,19 +684,32 @@ class Oxfs(LoggingMixIn, Operations):
     def truncate(self, path, length, fh=None):
         path = self.remotepath(path)
         cachefile = self.cachefile(path, False)
+        sftp = self.channel()
+        self._flush(path, sftp)
         self.mtx.lock(path)
-        if not os.path.exists(cachefile):
-            self.syncfile(self.sftp, path)
+        if self.manager.blockmap(cachefile) is not None:
+            # the blocks would stay next to a whole file fetched below
+            self.manager.pop(cachefile)
+        if not os.path.exists(cachefile) and not self.syncfile(sftp, path):
+            # large files are cached by blocks, drop them instead of patching
+            self.manager.pop(cachefile)
+            sftp.truncate(path, length)
+            self.attributes.remove(path)
+            self.mtx.unlock(path)
+            return
 
+        self.manager.writable(cachefile)
+        self.manager.mapped.invalidate(cachefile)
         os.truncate(cachefile, length)
         self.attributes.put(path, self.extract(os.lstat(cachefile)))
         self.mtx.unlock(path)
-        self.manager.put(cachefile)
-        self.sftp.truncate(path, length)
+        self.manager.put(cachefile, path)
+        sftp.truncate(path, length)
 
     def unlink(self, path):
         path = self.remotepath(path)
-        self.sftp.unlink(path)
+        self.writeback.discard(path)
+        self.channel().unlink(path)
         self.mtx.lock(path)
         self.manager.pop(self.cachefile(path, False))
         self.attributes.remove(path)
@@ -299,49 +719,117 @@ class Oxfs(LoggingMixIn, Operations):
 
     def utimens(self, path, times=None):
         path = self.remotepath(path)
-        self.sftp.utime(path, times)
+        self.channel().utime(path, times)
         self.attributes.remove(path)
         return 0
 
-    def _write(self, path, data, offset):
-        sftp = self.current_thread_sftp()
-        with sftp.open(path, 'rb+') as outfile:
-            outfile.seek(offset, 0)
-            outfile.write(data)
+    def _flush(self, path, sftp=None):
+        journal = self.writeback.journal(path)
+        if journal is None:
+            return
+        with journal.flushing:
+            extents = journal.take()
+            if not extents:
+                return
+            try:
+                sftp = sftp or self.channel()
+                if self.transfer.parallel(sum(len(data) for _, data in extents)):
+                    self.transfer.upload(path, extents)
+                    st = sftp.stat(path)
+                else:
+                    with sftp.open(path, 'rb+') as outfile:
+                        outfile.set_pipelined(True)
+                        for start, data in extents:
+                            outfile.seek(start, 0)
+                            outfile.write(data)
+                        st = outfile.stat()
+            except Exception as e:
+                self.logger.error('flush {} failed, {}'.format(path, e))
+                journal.restore(extents)
+                raise
+            self.metrics.add('upload_bytes', sum(len(data) for _, data in extents))
+            try:
+                self.validate(path, journal, st)
+            finally:
+                journal.done()
+
+    def validate(self, path, journal, st):
+        # a flushed cache file matches the remote, record it so change
+        # checks do not drop it
+        if not self.mtx.trylock(path):
+            return
+        cachefile = self.cachefile(path, False)
+        try:
+            if not journal.size and os.path.exists(cachefile) \
+                    and os.lstat(cachefile).st_size == st.st_size:
+                self.manager.put(cachefile, path, [st.st_mtime, st.st_size])
+                # a file still open may be written again, it is not worth a copy
+                if not self.handles.opened(path):
+                    self.manager.intern(cachefile)
+        finally:
+            self.mtx.unlock(path)
+
+    def submit_flush(self, path):
+        journal = self.writeback.journal(path)
+        if journal is not None and self.writeback.enqueue(journal):
+            self.submit(self._flush, path)
+
+    def settle(self, sftp, path):
+        # remote content is stale until the writes journaled for it are flushed
+        if self.writeback.dirty(path):
+            self._flush(path, sftp)
 
     def write(self, path, data, offset, fh):
         path = self.remotepath(path)
         cachefile = self.cachefile(path, False)
+        sftp = self.channel()
         self.mtx.lock(path)
-        if not os.path.exists(cachefile):
-            self.syncfile(self.sftp, path)
-
-        with open(cachefile, 'rb+') as outfile:
-            outfile.seek(offset, 0)
-            outfile.write(data)
-
-        self.attributes.put(path, self.extract(os.lstat(cachefile)))
+        datafile = cachefile
+        held = self.manager.hold(cachefile, offset, len(data))
+        try:
+            if not self.handles.cached(fh, cachefile) and not os.path.exists(cachefile):
+                if self.manager.blockmap(cachefile) is not None or not self.syncfile(sftp, path):
+                    datafile = self.fillblocks(
+                        sftp, path, cachefile, offset, len(data), True, fh)
+            self.manager.writable(datafile)
+            self.handles.pwrite(fh, datafile, data, offset)
+        finally:
+            self.manager.unhold(held)
+        # a mapping would miss the bytes written past its end
+        self.manager.mapped.invalidate(datafile)
+        self.attributes.put(path, self.extract(os.lstat(datafile)))
         self.mtx.unlock(path)
-        self.taskpool.submit(self._write, path, data, offset)
-        self.manager.put(cachefile)
+        if self.writeback.write(path, offset, data):
+            self.submit(self._flush, path)
+        if datafile == cachefile:
+            self.manager.put(cachefile, path)
         return len(data)
 
     def destroy(self, path):
         self.updater.shutdown()
+        if self.store is not None:
+            # a cycle under way still writes to the store and submits tasks
+            self.updater.thread.join()
+        self.warmup.shutdown()
+        if self.watcher is not None:
+            self.watcher.shutdown()
+        self.writeback.shutdown()
+        for dirty in self.writeback.pending():
+            self.submit(self._flush, dirty)
         self.taskpool.shutdown()
-        self.sftp.close()
-        self.client.close()
-        for curr in self.tls.values():
-            client = curr.get('client')
-            sftp = curr.get('sftp')
-            if sftp is not None:
-                sftp.close()
-                client.close()
-
-    def fuse_main(self, mount_point):
+        self.transfer.shutdown()
+        self.manager.shutdown()
+        if self.store is not None:
+            self.attributes.sync()
+            self.directories.sync()
+            self.store.close()
+        self.pool.close()
+        self.metrics.shutdown()
+
+    def fuse_main(self, mount_point, nothreads=True):
         self.__class__.__name__ = 'oxfs'
         if 'Darwin' == self.sys:
-            fuse = FUSE(self, mount_point, foreground=True, nothreads=True,
+            fuse = FUSE(self, mount_point, foreground=True, nothreads=nothreads,
                         allow_other=True, auto_cache=True,
                         uid=os.getuid(), gid=os.getgid(),
                         defer_permissions=True, kill_on_unmount=True,
@@ -349,7 +837,7 @@ class Oxfs(LoggingMixIn, Operations):
                         nosuid=True, nobrowse=True, 
                         volname=os.path.basename(os.path.normpath(mount_point)))
         elif 'Linux' == self.sys:
-            fuse = FUSE(self, mount_point, foreground=True, nothreads=True,
+            fuse = FUSE(self, mount_point, foreground=True, nothreads=nothreads,
                         allow_other=True, auto_cache=True,
                         uid=os.getuid(), gid=os.getgid(),
                         auto_unmount=True)
@@ -367,11 +855,42 @@ class Config:
         self.cache_path = None
         self.daemon = False
         self.auto_cache = False
+        self.multithreaded = False
 
         self.key_filename = None
         self.ssh_port = 22
         self.cache_timeout = 30
         self.parallel = multiprocessing.cpu_count() * 4
+        self.readahead = 8
+        self.writeback_interval = 1
+        self.cache_size = 2**10
+        self.cache_files = 0
+        self.cache_policy = 'lru'
+        self.min_free_space = 0
+        self.mapped_files = 256
+        self.cache_compression = 'none'
+        self.cache_dedup = False
+        self.ssh_compression = False
+        self.pinned = []
+        self.attr_timeout = 60
+        self.dir_timeout = 60
+        self.negative_timeout = 10
+        self.refresh_workers = 4
+        self.warmup_workers = 4
+        self.lock_stripes = 2048
+        self.ssh_connections = 2
+        self.ssh_channels = 8
+        self.ssh_keepalive = 30
+        self.transfer_chunk_size = 8
+        self.transfer_concurrency = 4
+        self.backend = 'sftp'
+        self.latency = 0
+        self.bandwidth = 0
+        self.watch = False
+        self.watch_command = None
+        self.refresh_rate = 0
+        self.metrics = False
+        self.metrics_port = 0
         self.remote_path = '/'
         self.filename = None
         self.level = logging.WARN
@@ -379,7 +898,9 @@ class Config:
 
     def parse(self):
         args = self.parser.parse_args()
-        if not args.host:
+        if args.backend:
+            self.backend = args.backend
+        if 'sftp' == self.backend and not args.host:
             self.parser.print_help()
             sys.exit()
         if not args.mount_point:
@@ -389,11 +910,12 @@ class Config:
             self.parser.print_help()
             sys.exit()
 
-        if '@' not in args.host:
+        if 'sftp' == self.backend and '@' not in args.host:
             self.parser.print_help()
             sys.exit()
 
-        self.user, _, self.host = args.host.partition('@')
+        if args.host:
+            self.user, _, self.host = args.host.partition('@')
         self.cache_path = os.path.abspath(args.cache_path)
         self.mount_point = os.path.abspath(args.mount_point)
 
@@ -403,6 +925,15 @@ class Config:
         if args.ssh_port:
             self.ssh_port = args.ssh_port
 
+        if args.ssh_connections:
+            self.ssh_connections = args.ssh_connections
+
+        if args.ssh_channels:
+            self.ssh_channels = args.ssh_channels
+
+        if args.ssh_keepalive is not None:
+            self.ssh_keepalive = args.ssh_keepalive
+
         if args.key_filename:
             self.key_filename = os.path.expanduser(args.key_filename)
 
@@ -412,12 +943,94 @@ class Config:
         if args.parallel:
             self.parallel = args.parallel
 
+        if args.cache_size:
+            self.cache_size = args.cache_size
+
+        if args.cache_files:
+            self.cache_files = args.cache_files
+
+        if args.cache_policy:
+            self.cache_policy = args.cache_policy
+
+        if args.min_free_space:
+            self.min_free_space = args.min_free_space
+
+        if args.mapped_files is not None:
+            self.mapped_files = args.mapped_files
+
+        if args.cache_compression:
+            self.cache_compression = args.cache_compression
+
+        if args.ssh_compression:
+            self.ssh_compression = True
+
+        if args.cache_dedup:
+            self.cache_dedup = True
+
+        if args.pinned:
+            self.pinned = args.pinned
+
+        if args.attr_timeout is not None:
+            self.attr_timeout = args.attr_timeout
+
+        if args.dir_timeout is not None:
+            self.dir_timeout = args.dir_timeout
+
+        if args.negative_timeout is not None:
+            self.negative_timeout = args.negative_timeout
+
+        if args.refresh_workers:
+            self.refresh_workers = args.refresh_workers
+
+        if args.warmup_workers:
+            self.warmup_workers = args.warmup_workers
+
+        if args.refresh_rate:
+            self.refresh_rate = args.refresh_rate
+
+        if args.lock_stripes:
+            self.lock_stripes = args.lock_stripes
+
+        if args.transfer_chunk_size:
+            self.transfer_chunk_size = args.transfer_chunk_size
+
+        if args.transfer_concurrency:
+            self.transfer_concurrency = args.transfer_concurrency
+
+        if args.latency:
+            self.latency = args.latency
+
+        if args.bandwidth:
+            self.bandwidth = args.bandwidth
+
+        if args.writeback_interval:
+            self.writeback_interval = args.writeback_interval
+
+        if args.readahead is not None:
+            self.readahead = args.readahead
+
         if args.logging:
             self.filename = args.logging
 
         if args.auto_cache:
             self.auto_cache = True
 
+        if args.watch:
+            self.watch = True
+
+        if args.watch_command:
+            self.watch_command = args.watch_command
+
+        if args.multithreaded:
+            self.multithreaded = True
+
+        if args.metrics:
+            self.metrics = True
+
+        if args.metrics_port:
+            self.metrics = True
+            self.metrics_port = args.metrics_port
+
         if args.verbose:
             self.level = logging.INFO
 
@@ -426,29 +1039,98 @@ class Config:
 
 
 def main():
-    parser = argparse.ArgumentParser()
+    if len(sys.argv) > 1 and 'warmup' == sys.argv[1]:
+        return warmup_main(sys.argv[2:])
+    if len(sys.argv) > 1 and 'copy' == sys.argv[1]:
+        return copy_main(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(
+        epilog='oxfs warmup -h: cache trees of a running mount, oxfs copy -h: copy on the remote host')
     parser.add_argument('--host', dest='host',
                         help='ssh host (example: root@127.0.0.1)')
     parser.add_argument('--ssh-key', dest='key_filename',
                         help='ssh key filename')
     parser.add_argument('--ssh-port', dest='ssh_port', type=int,
                         help='ssh port (defaut: 22)')
+    parser.add_argument('--backend', dest='backend', choices=['local', 'sftp'],
+                        help='sftp, or local to serve --remote-path of this host for testing (default: sftp)')
+    parser.add_argument('--latency', dest='latency', type=float,
+                        help='milliseconds added to each request of the local backend (default: 0)')
+    parser.add_argument('--bandwidth', dest='bandwidth', type=float,
+                        help='MB/s limit of the local backend (default: unlimited)')
+    parser.add_argument('--ssh-compression', dest='ssh_compression', action='store_true',
+                        help='compress the ssh transport, for slow links')
+    parser.add_argument('--ssh-connections', dest='ssh_connections', type=int,
+                        help='ssh connections in the channel pool (default: 2)')
+    parser.add_argument('--ssh-channels', dest='ssh_channels', type=int,
+                        help='sftp channels per ssh connection (default: 8)')
+    parser.add_argument('--ssh-keepalive', dest='ssh_keepalive', type=int,
+                        help='seconds between ssh keepalives, 0 to disable (default: 30)')
     parser.add_argument('--cache-timeout', dest='cache_timeout', type=int,
                         help='cache timeout (default: 30s)')
+    parser.add_argument('--attr-timeout', dest='attr_timeout', type=float,
+                        help='seconds file attributes are cached (default: 60s)')
+    parser.add_argument('--dir-timeout', dest='dir_timeout', type=float,
+                        help='seconds directory attributes and listings are cached (default: 60s)')
+    parser.add_argument('--negative-timeout', dest='negative_timeout', type=float,
+                        help='seconds missing paths are cached (default: 10s)')
+    parser.add_argument('--refresh-workers', dest='refresh_workers', type=int,
+                        help='sftp channels used by --auto-cache refreshes (default: 4)')
+    parser.add_argument('--refresh-rate', dest='refresh_rate', type=float,
+                        help='remote requests per second for --auto-cache refreshes (default: unlimited)')
+    parser.add_argument('--warmup-workers', dest='warmup_workers', type=int,
+                        help='sftp channels downloading trees given to oxfs warmup (default: 4)')
     parser.add_argument('--parallel', dest='parallel', type=int,
                         help='parallel (default: equal to cpu count)')
+    parser.add_argument('--transfer-chunk-size', dest='transfer_chunk_size', type=int,
+                        help='range in MB each channel moves of a large file (default: 8)')
+    parser.add_argument('--transfer-concurrency', dest='transfer_concurrency', type=int,
+                        help='channels used at once for a large file, 1 to disable (default: 4)')
+    parser.add_argument('--writeback-interval', dest='writeback_interval', type=float,
+                        help='seconds between write-back flushes (default: 1s)')
+    parser.add_argument('--readahead', dest='readahead', type=int,
+                        help='sequential read-ahead window in blocks, 0 to disable (default: 8)')
     parser.add_argument('--mount-point', dest='mount_point',
                         help='mount point')
     parser.add_argument('--remote-path', dest='remote_path',
                         help='remote path (default: /)')
     parser.add_argument('--cache-path', dest='cache_path',
                         help='cache path')
+    parser.add_argument('--cache-size', dest='cache_size', type=int,
+                        help='cache size limit in MB (default: 1024)')
+    parser.add_argument('--cache-files', dest='cache_files', type=int,
+                        help='cached files limit (default: unlimited)')
+    parser.add_argument('--cache-policy', dest='cache_policy', choices=sorted(POLICIES),
+                        help='cache eviction policy (default: lru)')
+    parser.add_argument('--min-free-space', dest='min_free_space', type=int,
+                        help='evict cache to keep this many MB free on the cache disk (default: 0)')
+    parser.add_argument('--mapped-files', dest='mapped_files', type=int,
+                        help='cache files kept memory mapped for reads, 0 to disable (default: 256)')
+    parser.add_argument('--cache-compression', dest='cache_compression',
+                        choices=['none', 'auto', 'zlib', 'lz4', 'zstd'],
+                        help='compress files downloaded ahead of use in the cache, auto picks zstd, lz4 then zlib (default: none)')
+    parser.add_argument('--cache-dedup', dest='cache_dedup', action='store_true',
+                        help='store identical files once, a copy shares the cache of its source')
+    parser.add_argument('--pin', dest='pinned', action='append',
+                        help='never evict cached files under this path of the mount, may be repeated')
+    parser.add_argument('--lock-stripes', dest='lock_stripes', type=int,
+                        help='shared locks used once too many paths are locked (default: 2048)')
     parser.add_argument('--logging', dest='logging',
                         help='logging file')
     parser.add_argument('--daemon', dest='daemon', action='store_true',
                         help='daemon')
     parser.add_argument('--auto-cache', dest='auto_cache', action='store_true',
                         help='auto update cache')
+    parser.add_argument('--watch', dest='watch', action='store_true',
+                        help='invalidate cache from remote inotify events, polling is the fallback')
+    parser.add_argument('--watch-command', dest='watch_command',
+                        help='remote command printing READY then "event path" lines for {path}')
+    parser.add_argument('--multithreaded', dest='multithreaded', action='store_true',
+                        help='run fuse callbacks concurrently, one sftp channel per worker')
+    parser.add_argument('--metrics', dest='metrics', action='store_true',
+                        help='record per operation metrics, read from /.oxfs/stats and /.oxfs/metrics of the mount')
+    parser.add_argument('--metrics-port', dest='metrics_port', type=int,
+                        help='serve prometheus metrics on this localhost port, implies --metrics')
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
                         help='debug info')
 
@@ -459,20 +1141,49 @@ def main():
                         format=config.fmt,
                         filename=config.filename)
 
+    backend = None
+    if 'local' == config.backend:
+        backend = LocalBackend(config.latency, config.bandwidth)
+
     fs = Oxfs(host=config.host,
               user=config.user,
               cache_path=config.cache_path,
               remote_path=config.remote_path,
               port=config.ssh_port,
-              key_filename=config.key_filename)
+              key_filename=config.key_filename,
+              readahead=config.readahead,
+              lock_stripes=config.lock_stripes,
+              pool_options=dict(max_clients=config.ssh_connections,
+                                channels=config.ssh_channels,
+                                keepalive=config.ssh_keepalive),
+              transfer_options=dict(chunk_mb=config.transfer_chunk_size,
+                                    concurrency=config.transfer_concurrency),
+              cache_options=dict(max_disk_size_mb=config.cache_size,
+                                 max_files=config.cache_files,
+                                 min_free_mb=config.min_free_space,
+                                 policy=config.cache_policy,
+                                 mapped_files=config.mapped_files,
+                                 compression=config.cache_compression,
+                                 dedup=config.cache_dedup,
+                                 pinned=config.pinned),
+              ttls=dict(attr=config.attr_timeout,
+                        dir=config.dir_timeout,
+                        negative=config.negative_timeout),
+              backend=backend,
+              metrics=config.metrics,
+              compress=config.ssh_compression)
 
     if config.daemon:
         fs.spawnvpe()
         sys.exit()
 
     fs.start_thread_pool(config.parallel)
+    fs.start_write_back(config)
     fs.start_cache_updater(config)
-    fs.fuse_main(config.mount_point)
+    fs.start_watcher(config)
+    fs.start_warmup(config)
+    fs.start_metrics(config)
+    fs.fuse_main(config.mount_point, not config.multithreaded)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+import logging
+import threading
+import time
+
+
+class ChannelPool:
+    '''
+    SFTP channels multiplexed over a few connections of `backend`,
+    `channels` per connection and `max_clients` connections. A channel is
+    leased by one thread at a time. When every channel is busy, acquire
+    waits up to `wait` seconds and then opens an extra channel on the least
+    busy connection rather than block, it is closed once idle for `linger`
+    seconds. A server refusing that channel makes acquire wait for a release
+    instead. Dead connections are dropped and reconnected on demand, one at
+    a time, with exponential backoff after failures.
+    '''
+
+    def __init__(self, backend, max_clients=2, channels=8, keepalive=30, wait=1, linger=5):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.backend = backend
+        self.max_clients = max_clients
+        self.channels = channels
+        self.keepalive = keepalive
+        self.wait = wait
+        self.linger = linger
+        self.cond = threading.Condition()
+        self.clients = dict()  # key: client, value: channels open on it
+        self.owners = dict()  # key: channel, value: its client
+        self.idle = []
+        self.released = dict()  # key: idle channel, value: when it was released
+        self.busy = set()
+        self.connecting = False
+        self.failures = 0
+        self.retry = 0  # no connect attempt before this time
+        self.listeners = []  # called with each closed channel
+        self.stats = dict(opened=0, closed=0, overflow=0, connects=0)
+
+    @property
+    def size(self):
+        return self.max_clients * self.channels
+
+    def active(self, client):
+        return self.backend.active(client)
+
+    def alive(self, sftp):
+        client = self.owners.get(sftp)
+        return client is not None and self.backend.alive(sftp) and self.active(client)
+
+    def acquire(self, wait=None):
+        '''
+        Leases a channel, `wait` overrides the seconds to wait for one to be
+        released before an extra channel is opened.
+        '''
+        deadline = time.time() + (self.wait if wait is None else wait)
+        extra = True  # the server may refuse an extra channel
+        while True:
+            overflow = False
+            with self.cond:
+                while True:
+                    sftp = self.take()
+                    if sftp is not None:
+                        return sftp
+                    remaining = deadline - time.time()
+                    # channels being opened count, as does the one a connect opens
+                    if sum(self.clients.values()) + self.connecting < self.size:
+                        client = self.reserve()
+                    elif remaining <= 0 and extra:
+                        # on a connection already made unless none is left
+                        client = self.reserve(True)
+                        overflow = True
+                    else:
+                        self.cond.wait(remaining if remaining > 0 else None)
+                        continue
+                    if client is not None or not self.connecting:
+                        break
+                    # no connection yet, wait for the one being made
+                    overflow = False
+                    self.cond.wait()
+                if client is None:
+                    self.connecting = True
+                if overflow:
+                    self.stats['overflow'] += 1
+
+            # connecting and opening a channel are slow, not under the pool lock
+            if client is None:
+                client = self.reconnect()
+            try:
+                sftp = self.backend.open(client)
+            except Exception as e:
+                with self.cond:
+                    self.clients[client] -= 1
+                    self.drop(client)
+                if not overflow:
+                    raise
+                self.logger.warning('extra channel refused, waiting for one, {}'.format(e))
+                extra = False
+                continue
+            with self.cond:
+                self.owners[sftp] = client
+                self.busy.add(sftp)
+                self.stats['opened'] += 1
+            return sftp
+
+    def take(self):
+        # an idle live channel, called with the lock held
+        while self.idle:
+            sftp = self.idle.pop()
+            self.released.pop(sftp, None)
+            if self.alive(sftp):
+                self.busy.add(sftp)
+                return sftp
+            self.discard(sftp)
+        return None
+
+    def release(self, sftp):
+        with self.cond:
+            self.busy.discard(sftp)
+            if self.alive(sftp):
+                self.idle.append(sftp)
+                self.released[sftp] = time.time()
+            else:
+                self.discard(sftp)
+            self.trim()
+            self.cond.notify()
+
+    def trim(self):
+        # extra channels are kept for the next burst, the oldest idle ones
+        # are closed once they outlast `linger`, called with the lock held
+        expired = time.time() - self.linger
+        while (len(self.idle) + len(self.busy) > self.size and
+               self.released[self.idle[0]] <= expired):
+            sftp = self.idle.pop(0)
+            del self.released[sftp]
+            self.discard(sftp)
+
+    def client(self, sftp):
+        with self.cond:
+            return self.owners.get(sftp)
+
+    def live(self):
+        return [client for client in self.clients if self.active(client)]
+
+    def reserve(self, extra=False):
+        '''
+        Returns the least busy live connection with room for one more
+        channel, any with `extra`, once `max_clients` are made or while one
+        is being made, or None if a new connection is needed.
+        '''
+        live = self.live()
+        if not live:
+            return None
+        client = min(live, key=self.clients.get)
+        if (extra or self.clients[client] < self.channels or self.connecting or
+                len(live) >= self.max_clients):
+            self.clients[client] += 1
+            return client
+        return None
+
+    def reconnect(self):
+        # the one connect under way, acquire calls wait for it to be done
+        try:
+            with self.cond:
+                wait = self.retry - time.time()
+            if wait > 0:
+                raise ConnectionError('reconnect backoff, retry in {:.1f}s'.format(wait))
+            try:
+                client = self.backend.connect()
+            except Exception as e:
+                with self.cond:
+                    self.failures += 1
+                    self.retry = time.time() + min(2 ** self.failures, 60)
+                self.logger.error('connect failed, {}'.format(e))
+                raise
+            self.backend.keepalive(client, self.keepalive)
+        except Exception:
+            with self.cond:
+                self.connecting = False
+                self.cond.notify_all()
+            raise
+        with self.cond:
+            self.connecting = False
+            self.failures = 0
+            self.clients[client] = 1
+            self.stats['connects'] += 1
+            self.cond.notify_all()
+        return client
+
+    def discard(self, sftp):
+        client = self.owners.pop(sftp, None)
+        if client is None:
+            return
+        self.clients[client] -= 1
+        self.stats['closed'] += 1
+        try:
+            sftp.close()
+        except Exception as e:
+            self.logger.debug(e)
+        for listener in self.listeners:
+            listener(sftp)
+        self.drop(client)
+
+    def drop(self, client):
+        # close a connection once its last channel is gone if it died or
+        # more than max_clients are left
+        if self.clients[client]:
+            return
+        if self.active(client) and len(self.live()) <= self.max_clients:
+            return
+        del self.clients[client]
+        client.close()
+
+    def counts(self):
+        with self.cond:
+            return dict(in_use=len(self.busy), idle=len(self.idle),
+                        clients=len(self.clients), **self.stats)
+
+    def close(self):
+        with self.cond:
+            for sftp in self.idle + list(self.busy):
+                sftp.close()
+            for client in self.clients:
+                client.close()
+            self.idle, self.busy = [], set()
+            self.released = dict()
+            self.clients, self.owners = dict(), dict()
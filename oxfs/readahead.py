@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+import collections
+import threading
+
+
+class Stream:
+    def __init__(self):
+        self.pos = 0
+        self.window = 0
+        self.ahead = 0
+        self.pending = dict()  # key: block index in flight, value: its prefetch future
+
+
+class ReadAhead:
+    '''
+    Tracks the read position of each file, a read starting where the last one
+    ended grows the window of blocks to prefetch, any other read resets it.
+    '''
+
+    def __init__(self, blocksize, max_window=8, max_streams=1024):
+        self.blocksize = blocksize
+        self.max_window = max_window
+        self.max_streams = max_streams
+        self.streams = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def advise(self, path, offset, size, filesize):
+        '''
+        Returns None on random access, otherwise the block indexes to fetch
+        ahead of this read (possibly empty).
+        '''
+        bs = self.blocksize
+        with self.lock:
+            stream = self.streams.pop(path, None)
+            if stream is None:
+                stream = Stream()
+                if len(self.streams) >= self.max_streams:
+                    self.streams.popitem(last=False)
+            self.streams[path] = stream
+
+            sequential = offset == stream.pos
+            stream.pos = offset + size
+            if not sequential or self.max_window <= 0:
+                stream.window, stream.ahead = 0, 0
+                return None
+
+            stream.window = min(max(stream.window * 2, 1), self.max_window)
+            current = (offset + max(size, 1) - 1) // bs
+            begin = max(stream.ahead, current + 1)
+            end = min(current + stream.window, (filesize - 1) // bs)
+            if begin > end:
+                return []
+            stream.ahead = end + 1
+            return list(range(begin, end + 1))
+
+    def submit(self, path, indexes, future):
+        with self.lock:
+            stream = self.streams.get(path)
+            if stream is None:
+                return
+            for index in indexes:
+                stream.pending[index] = future
+        future.add_done_callback(lambda future: self.landed(stream, indexes, future))
+
+    def landed(self, stream, indexes, future):
+        with self.lock:
+            for index in indexes:
+                if stream.pending.get(index) is future:
+                    del stream.pending[index]
+
+    def wait(self, path, offset, size):
+        # let every in flight prefetch of these blocks land instead of
+        # fetching them again
+        bs = self.blocksize
+        first, last = offset // bs, (offset + max(size, 1) - 1) // bs
+        with self.lock:
+            stream = self.streams.get(path)
+            if stream is None:
+                return
+            futures = set(stream.pending[index] for index in range(first, last + 1)
+                          if index in stream.pending)
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                pass
+
+    def forget(self, path):
+        with self.lock:
+            self.streams.pop(path, None)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import logging
+import os
+import shlex
+import shutil
+import stat
+import sys
+import threading
+
+from oxfs.control import CONTROL
+from oxfs.warmup import mountroot
+
+
+class RemoteCopy:
+    '''
+    Copies files and trees within the remote without moving their data
+    through this host: with the sftp copy-data extension when the server
+    has it, else with cp run over ssh, streaming through the channel as a
+    last resort. The cache files and attributes of the copies are made from
+    the ones of their sources. Copies run on the task pool, `status` tells
+    how each one went.
+    '''
+
+    def __init__(self, oxfs):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.oxfs = oxfs
+        self.stats = dict(copy_data=0, exec=0, stream=0)
+        self.lock = threading.Lock()
+        self.jobs = dict()  # key: command line, value: its state and error
+
+    def command(self, line):
+        '''
+        Queues a line written to the control file, `SRC DST` with both paths
+        in the mount. DST may be a directory to copy SRC into.
+        '''
+        words = shlex.split(line)
+        if len(words) != 2 or not all(word.startswith('/') for word in words):
+            raise ValueError('usage: /src /dst')
+        self.update(line, state='queued', error=None)
+        self.oxfs.submit(self.run, line, *[self.oxfs.remotepath(word) for word in words])
+
+    def run(self, line, src, dst):
+        self.update(line, state='copying')
+        try:
+            self.copy(src, dst)
+        except Exception as e:
+            self.logger.error('copy {} failed, {}'.format(line, e))
+            self.update(line, state='failed', error=str(e))
+            return
+        self.update(line, state='done')
+
+    def status(self):
+        with self.lock:
+            return dict((line, dict(job)) for line, job in self.jobs.items())
+
+    def update(self, line, **kwargs):
+        with self.lock:
+            self.jobs.setdefault(line, dict()).update(kwargs)
+
+    def copy(self, src, dst):
+        oxfs = self.oxfs
+        sftp = oxfs.channel()
+        # the remote copy must see the writes still journaled
+        for path in oxfs.writeback.below(src):
+            oxfs._flush(path, sftp)
+        try:
+            if stat.S_ISDIR(sftp.stat(dst).st_mode):
+                dst = os.path.join(dst, os.path.basename(src))
+        except IOError:
+            pass
+        # writes journaled for the targets would overwrite the copies
+        for path in oxfs.writeback.below(dst):
+            try:
+                sftp.lstat(src + path[len(dst):])
+            except IOError:
+                continue
+            journal = oxfs.writeback.journal(path)
+            if journal is not None:
+                # a flush under way lands before the copy
+                with journal.flushing:
+                    oxfs.writeback.discard(path)
+        attr = sftp.stat(src)
+        if stat.S_ISDIR(attr.st_mode):
+            self.copytree(sftp, src, dst)
+        else:
+            self.copyfile(sftp, src, dst, attr)
+        self.cache(sftp, src, dst)
+
+    def copytree(self, sftp, src, dst):
+        try:
+            sftp.stat(dst)
+        except IOError:
+            # a new tree is copied by one command
+            if self.execute(sftp, 'cp -R', src, dst):
+                return
+            sftp.mkdir(dst)
+        for attr in sftp.listdir_attr(src):
+            source = os.path.join(src, attr.filename)
+            target = os.path.join(dst, attr.filename)
+            if stat.S_ISDIR(attr.st_mode):
+                self.copytree(sftp, source, target)
+            elif stat.S_ISLNK(attr.st_mode):
+                sftp.symlink(sftp.readlink(source), target)
+            else:
+                self.copyfile(sftp, source, target, attr)
+
+    def copyfile(self, sftp, src, dst, attr):
+        if not self.copydata(sftp, src, dst):
+            if self.execute(sftp, 'cp', src, dst):
+                return
+            self.logger.info('copy {} through this host'.format(src))
+            with sftp.open(src, 'rb') as infile, sftp.open(dst, 'wb') as outfile:
+                infile.prefetch()
+                outfile.set_pipelined(True)
+                shutil.copyfileobj(infile, outfile, 2**20)
+            self.stats['stream'] += 1
+        # as cp does for a new file
+        sftp.chmod(dst, stat.S_IMODE(attr.st_mode))
+
+    def copydata(self, sftp, src, dst):
+        copy_data = getattr(sftp, 'copy_data', None)
+        if copy_data is None:
+            return False
+        try:
+            with sftp.open(src, 'rb') as infile, sftp.open(dst, 'wb') as outfile:
+                copy_data(infile, outfile)
+        except IOError as e:
+            self.logger.debug('copy-data {}, {}'.format(src, e))
+            return False
+        self.stats['copy_data'] += 1
+        return True
+
+    def execute(self, sftp, command, src, dst):
+        client = self.oxfs.pool.client(sftp)
+        if client is None:
+            return False
+        try:
+            stdin, stdout, stderr = client.exec_command('{} -- {} {}'.format(
+                command, shlex.quote(src), shlex.quote(dst)))
+            stdout.read()
+            error = stderr.read().decode('utf-8', 'replace').strip()
+            status = stdout.channel.recv_exit_status()
+            stdin.close(), stdout.close(), stderr.close()
+        except Exception as e:
+            self.logger.debug('{} {}, {}'.format(command, src, e))
+            return False
+        if 0 != status:
+            self.logger.debug('{} {}, {}'.format(command, src, error))
+            return False
+        self.stats['exec'] += 1
+        return True
+
+    def cache(self, sftp, src, dst):
+        # what was cached under `dst` may have been overwritten, the copies
+        # get the cache files and attributes of their sources
+        oxfs = self.oxfs
+        oxfs.attributes.expire(dst)
+        oxfs.directories.expire(dst)
+        for path in [dst] + oxfs.manager.below(dst):
+            if oxfs.writeback.dirty(path):
+                # not a target, its writes are still to go out
+                continue
+            oxfs.mtx.lock(path)
+            oxfs.manager.pop(oxfs.cachefile(path, False))
+            oxfs.mtx.unlock(path)
+        for path in [src] + oxfs.manager.below(src):
+            target = dst + path[len(src):]
+            attr = oxfs.extract(sftp.lstat(target))
+            targetfile = oxfs.cachefile(target, False)
+            oxfs.attributes.put(target, attr)
+            if not stat.S_ISREG(attr['st_mode']):
+                continue
+            oxfs.mtx.rlock(path)
+            try:
+                sourcefile = oxfs.cachefile(path, False)
+                if os.path.exists(sourcefile):
+                    oxfs.manager.duplicate(sourcefile, targetfile, target,
+                                           [attr['st_mtime'], attr['st_size']])
+            finally:
+                oxfs.mtx.runlock(path)
+        oxfs.relist(os.path.dirname(dst), add=os.path.basename(dst))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='oxfs copy', description='copy files and trees within a running oxfs mount on the remote host')
+    parser.add_argument('paths', nargs='*', metavar='SRC',
+                        help='files or directories in an oxfs mount')
+    parser.add_argument('dst', metavar='DST',
+                        help='the copy, or a directory to copy into, in the same mount')
+    parser.add_argument('--status', dest='status', action='store_true',
+                        help='print how the copies of the mount of DST went')
+    args = parser.parse_args(argv)
+
+    dst = os.path.abspath(args.dst)
+    root = mountroot(dst)
+    if root is None:
+        parser.error('{} is not in an oxfs mount'.format(dst))
+    if len(args.paths) > 1 and not os.path.isdir(dst):
+        parser.error('{} is not a directory'.format(dst))
+    control = os.path.join(root, CONTROL[1:], 'copy')
+    if args.status:
+        with open(control, 'r') as infile:
+            json.dump(json.load(infile), sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return
+    if not args.paths:
+        parser.error('the following arguments are required: SRC')
+    for path in args.paths:
+        path = os.path.abspath(path)
+        if mountroot(path) != root:
+            parser.error('{} is not in the mount of {}'.format(path, dst))
+        words = ['/' + os.path.relpath(p, root) for p in (path, dst)]
+        words = ['/' if '/.' == word else word for word in words]
+        with open(control, 'w') as outfile:
+            outfile.write(' '.join(shlex.quote(word) for word in words) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+from concurrent.futures import ThreadPoolExecutor, wait
+import logging
+import os
+import threading
+import time
+
+
+class Transfer:
+    '''
+    Moves large files in `chunk_mb` ranges over up to `concurrency` pooled
+    channels at once, so one channel's window does not cap throughput.
+    `progress` maps each running transfer to [bytes done, bytes total].
+    '''
+
+    def __init__(self, pool, chunk_mb=8, concurrency=4):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.pool = pool
+        self.chunksize = chunk_mb << 20
+        self.concurrency = concurrency
+        self.executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix='oxfs-transfer')
+        self.lock = threading.Lock()
+        self.progress = dict()
+        self.stats = dict(downloads=0, uploads=0, bytes=0, seconds=0.0)
+
+    def parallel(self, size):
+        return self.concurrency > 1 and size > self.chunksize
+
+    def chunks(self, extents):
+        for start, length in extents:
+            for offset in range(start, start + length, self.chunksize):
+                yield offset, min(self.chunksize, start + length - offset)
+
+    def download(self, path, localfile, size):
+        fd = os.open(localfile, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self.run('downloads', path, size, self.fetch, fd,
+                     list(self.chunks([(0, size)])))
+        finally:
+            os.close(fd)
+
+    def upload(self, path, extents):
+        '''
+        Writes [(offset, data)] to the remote file.
+        '''
+        chunks = []
+        for start, data in extents:
+            for offset, length in self.chunks([(start, len(data))]):
+                chunks.append((offset, data[offset - start:offset - start + length]))
+        self.run('uploads', path, sum(len(d) for _, d in extents), self.push, None, chunks)
+
+    def run(self, kind, path, size, fn, fd, chunks):
+        key = (kind, path)
+        started = time.time()
+        with self.lock:
+            self.progress[key] = [0, size]
+        try:
+            futures = [self.executor.submit(fn, key, path, fd, chunk) for chunk in chunks]
+            # every chunk must be done before the file is used or retried
+            wait(futures)
+            for future in futures:
+                future.result()
+        finally:
+            with self.lock:
+                del self.progress[key]
+        elapsed = time.time() - started
+        with self.lock:
+            self.stats[kind] += 1
+            self.stats['bytes'] += size
+            self.stats['seconds'] += elapsed
+        self.logger.info('{} {} bytes of {} in {:.2f}s, {} chunks'.format(
+            kind, size, path, elapsed, len(chunks)))
+
+    def advance(self, key, n):
+        with self.lock:
+            self.progress[key][0] += n
+
+    def fetch(self, key, path, fd, chunk):
+        offset, length = chunk
+        sftp = self.pool.acquire()
+        try:
+            with sftp.open(path, 'rb') as infile:
+                for data in infile.readv([chunk]):
+                    os.pwrite(fd, data, offset)
+                    offset += len(data)
+                    self.advance(key, len(data))
+        finally:
+            self.pool.release(sftp)
+        if offset != chunk[0] + length:
+            raise EOFError('short read of {} at {}'.format(path, offset))
+
+    def push(self, key, path, fd, chunk):
+        offset, data = chunk
+        sftp = self.pool.acquire()
+        try:
+            with sftp.open(path, 'rb+') as outfile:
+                outfile.set_pipelined(True)
+                outfile.seek(offset, 0)
+                outfile.write(data)
+        finally:
+            self.pool.release(sftp)
+        self.advance(key, len(data))
+
+    def status(self):
+        with self.lock:
+            return [(kind, path, done, total)
+                    for (kind, path), (done, total) in self.progress.items()]
+
+    def shutdown(self):
+        self.executor.shutdown()
@@ -1,28 +1,63 @@
 #!/usr/bin/env python
 
 from concurrent.futures import ThreadPoolExecutor
-import hashlib
+import functools
 import logging
 import os
-import pathlib
 import stat
 import threading
 import time
 
 from errno import ENOENT
+from oxfs.cache.digest import Digests, remote_digests
 from oxfs.cache.fs import CacheManager
 from oxfs.lock import Lock as Mutex
 
 
+class RateLimit:
+    '''
+    Spaces out remote requests to at most `rate` per second, 0 for no limit.
+    '''
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next = 0
+
+    def acquire(self):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            wait = self.next - now
+            self.next = max(self.next, now) + 1 / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
 class CacheUpdater:
-    def __init__(self, oxfs, period):
+    '''
+    Refreshes the cached entries about to expire on `workers` threads, each
+    leasing its own sftp channel, most recently read or changed first. With a `rps`
+    budget a cycle takes what fits in one period, the rest is kept as
+    backlog for the next cycle.
+    '''
+
+    def __init__(self, oxfs, period, workers=4, rps=0):
         self.logger = logging.getLogger(__class__.__name__)
         self.oxfs = oxfs
         self.mtx: Mutex = oxfs.mtx
-        self.pool: ThreadPoolExecutor = oxfs.taskpool
         self.manager: CacheManager = oxfs.manager
         self.period = period
+        self.workers = workers
+        self.limit = RateLimit(rps)
+        self.budget = (int(rps * period) or 1) if rps else None
+        self.last = 0  # start of the previous cycle
+        self.backlog = dict()  # key: (kind, path), value: priority
+        self.changed = dict()  # key: path, value: time a change was seen
+        self.stats = dict(cycles=0, duration=0.0, refreshed=0, backlog=0)
         self.running = True
+        self.stopped = threading.Event()  # wakes the loop on shutdown
 
     def run(self):
         self.thread = threading.Thread(target=self.loop, args=())
@@ -32,15 +67,68 @@ class CacheUpdater:
 
     def shutdown(self):
         self.running = False
+        self.stopped.set()
 
     def loop(self):
-        self.client, self.sftp = self.oxfs.open_sftp()
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix='cache-updater')
+        wait = self.period
         while self.running:
-            time.sleep(self.period)
-            self.renew_lstat()
-            self.renew_listdir()
-        self.sftp.close()
-        self.client.close()
+            if self.stopped.wait(wait):
+                break
+            start = time.time()
+            refreshed = self.cycle(start)
+            self.oxfs.attributes.sync()
+            self.oxfs.directories.sync()
+            duration = time.time() - start
+            # a late cycle starts the next one right away
+            wait = max(self.period - duration, 0)
+            self.stats.update(cycles=self.stats['cycles'] + 1, duration=duration,
+                              refreshed=refreshed, backlog=len(self.backlog))
+            if refreshed or self.backlog:
+                self.logger.info('refreshed {} paths in {:.2f}s, backlog {}'.format(
+                    refreshed, duration, len(self.backlog)))
+        self.executor.shutdown()
+
+    def cycle(self, now):
+        since, self.last = self.last, now
+        horizon = now - 10 * self.period
+        self.changed = dict((path, t) for path, t in self.changed.items() if t > horizon)
+
+        # pinned trees are kept fresh even when nobody reads them
+        keep = self.manager.covers
+        for path, _, accessed in self.oxfs.directories.due(self.period, since, keep):
+            self.schedule('dir', path, accessed)
+        dirs = self.take('dir', self.budget)
+        renewed = set()
+        task = functools.partial(self.oxfs.background, self.renew_listdir)
+        for children in self.executor.map(task, dirs):
+            renewed.update(children)
+
+        for path, value, accessed in self.oxfs.attributes.due(self.period, since, keep):
+            # negative entries are not refreshed, they just expire
+            if ENOENT != value:
+                self.schedule('attr', path, accessed)
+        budget = self.budget and max(self.budget - len(dirs), 0)
+        attrs = [path for path in self.take('attr', budget) if path not in renewed]
+        task = functools.partial(self.oxfs.background, self.renew_lstat)
+        list(self.executor.map(task, attrs))
+        return len(dirs) + len(attrs)
+
+    def schedule(self, kind, path, accessed):
+        # a path that just changed is likely to change again
+        priority = max(accessed, self.changed.get(path, 0))
+        key = (kind, path)
+        self.backlog[key] = max(priority, self.backlog.get(key, 0))
+
+    def take(self, kind, budget=None):
+        keys = sorted((key for key in self.backlog if key[0] == kind),
+                      key=self.backlog.get, reverse=True)
+        if budget is not None:
+            keys = keys[:budget]
+        for key in keys:
+            del self.backlog[key]
+        return [path for _, path in keys]
 
     def skip_syncfile(self, path, cached, remote):
         cachefile = self.manager.cachefile(path)
@@ -49,61 +137,117 @@ class CacheUpdater:
             return True
 
         if not os.path.exists(cachefile):
-            return True
+            # a stale partial cache can not be verified, drop it
+            return self.manager.blockmap(cachefile) is None
 
-        if cached['st_size'] != remote['st_size']:
+        if not stat.S_ISREG(remote['st_mode']):
             return False
-
-        if os.lstat(cachefile).st_size != remote['st_size']:
-            return False
-
-        stdin, stdout, stderr = self.client.exec_command(
-            'md5sum {}'.format(path))
-        remote_md5sum = stdout.read().decode('utf-8').split(' ')[0]
-        stdin.close(), stdout.close(), stderr.close()
-        cached_md5sum = hashlib.md5(pathlib.Path(
-            cachefile).read_bytes()).hexdigest()
-        self.logger.info(cached_md5sum)
-        self.logger.info(remote_md5sum)
-        if cached_md5sum == remote_md5sum:
+        if self.manager.validator(cachefile) == [remote['st_mtime'], remote['st_size']]:
             return True
+        return self.patch(path, cachefile, remote)
+
+    def patch(self, path, cachefile, attr):
+        '''
+        Compares block digests with the remote file and downloads only the
+        blocks that differ, returns False if the remote can not hash blocks.
+        '''
+        bs, size = self.manager.blocksize, attr['st_size']
+        sftp = self.oxfs.channel()
+        client = self.oxfs.pool.client(sftp)
+        self.limit.acquire()
+        algo, remote = remote_digests(client, sftp, path, bs)
+        if remote is None or len(remote) != -(-size // bs):
+            return False
 
-        return False
-
-    def renew_lstat(self):
-        attributes = self.oxfs.attributes
-        cache = attributes.copy()
-        for path, value in cache.items():
-            if not self.mtx.trylock(path):
-                continue
-            attr = ENOENT
+        self.manager.writable(cachefile)
+        self.manager.mapped.invalidate(cachefile)
+        if os.lstat(cachefile).st_size != size:
+            os.truncate(cachefile, size)
+        digests = Digests(self.manager.digestfile(cachefile), bs)
+        local = digests.load(cachefile, algo)
+        changed = [i for i, d in enumerate(remote)
+                   if i >= len(local) or local[i] != d]
+        if changed:
+            self.logger.info('patch {} of {} blocks, {}'.format(
+                len(changed), len(remote), path))
+            chunks = [(i * bs, min(bs, size - i * bs)) for i in changed]
+            fd = os.open(cachefile, os.O_WRONLY)
             try:
-                attr = self.oxfs.extract(self.sftp.lstat(path))
-            except Exception as e:
-                self.logger.debug(e)
-
-            if type(value) == dict and stat.S_ISDIR(value['st_mode']):
-                attributes.put(path, attr)
-                self.mtx.unlock(path)
-                continue
-
-            if value != attr:
-                self.logger.info(path)
-                if not self.skip_syncfile(path, value, attr):
-                    self.manager.pop(self.manager.cachefile(path))
-                    attributes.put(path, attr)
-                    self.pool.submit(self.oxfs._getfile, path)
-
+                with sftp.open(path, 'rb') as infile:
+                    for (start, _), data in zip(chunks, infile.readv(chunks)):
+                        os.pwrite(fd, data, start)
+            finally:
+                os.close(fd)
+            digests.save(cachefile, algo, remote)
+        self.manager.put(cachefile, path, [attr['st_mtime'], size])
+        return True
+
+    def renew_attr(self, path, value, attr):
+        attributes = self.oxfs.attributes
+        if self.oxfs.writeback.dirty(path):
+            # the remote lags behind until the journal is flushed
+            return
+        if type(value) == dict and stat.S_ISDIR(value['st_mode']):
+            attributes.put(path, attr, True)
+            return
+
+        if value != attr:
+            self.logger.info(path)
+            self.changed[path] = time.time()
+            if not self.skip_syncfile(path, value, attr):
+                self.manager.pop(self.manager.cachefile(path))
+                self.oxfs.submit(self.oxfs._getfile, path)
+        # put even if unchanged, it starts a new lifetime
+        attributes.put(path, attr, True)
+
+    def renew_lstat(self, path):
+        value = self.oxfs.attributes.peek(path)
+        if value is None or ENOENT == value:
+            return
+        if not self.mtx.trylock(path):
+            return
+        attr = ENOENT
+        try:
+            self.limit.acquire()
+            attr = self.oxfs.extract(self.oxfs.channel().lstat(path))
+        except Exception as e:
+            self.logger.debug(e)
+
+        try:
+            self.renew_attr(path, value, attr)
+        finally:
             self.mtx.unlock(path)
 
-    def renew_listdir(self):
+    def renew_listdir(self, path):
+        attributes = self.oxfs.attributes
         directories = self.oxfs.directories
-        cache = directories.copy()
-        for path, value in cache.items():
-            entries = None
+        value = directories.peek(path)
+        if value is None:
+            return ()
+        try:
+            self.limit.acquire()
+            attrs = self.oxfs.channel().listdir_attr(path)
+        except Exception as e:
+            self.logger.debug(e)
+            return ()
+
+        entries = [attr.filename for attr in attrs]
+        if sorted(value) != sorted(entries):
+            self.changed[path] = time.time()
+            if self.manager.covers(path):
+                # fetch what was added to a pinned tree
+                self.oxfs.warmup.changed(path)
+        directories.put(path, entries, True)
+
+        renewed = set()
+        for attr in attrs:
+            child = os.path.join(path, attr.filename)
+            cached = attributes.peek(child)
+            if cached is None or not self.mtx.trylock(child):
+                continue
             try:
-                entries = self.sftp.listdir(path)
-                if sorted(value) != sorted(entries):
-                    directories.put(path, entries)
-            except Exception as e:
-                self.logger.debug(e)
+                self.renew_attr(child, cached, self.oxfs.extract(attr))
+            finally:
+                self.mtx.unlock(child)
+            renewed.add(child)
+        return renewed
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import fnmatch
+import functools
+import json
+import logging
+import os
+import queue
+import shlex
+import stat
+import sys
+import threading
+
+from oxfs.control import CONTROL
+
+
+class WarmUp:
+    '''
+    Fills the caches with remote trees before they are used. A tree is
+    walked level by level with listdir_attr, caching every listing and
+    attribute, then the files matching its globs are downloaded smallest
+    first by `workers` channels, up to the cache size. A pinned tree is
+    never evicted, the cache updater keeps it fresh and fetches the files
+    added to it.
+    '''
+
+    def __init__(self, oxfs, workers=4):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.oxfs = oxfs
+        self.workers = workers
+        self.queue = queue.Queue()  # of (root, path) to walk
+        self.lock = threading.Lock()
+        self.trees = dict()  # key: remote root, value: its patterns, pin and progress
+        self.running = True
+
+    def run(self):
+        self.thread = threading.Thread(target=self.loop, args=())
+        self.thread.daemon = True
+        self.thread.name = 'warm-up'
+        self.thread.start()
+
+    def shutdown(self):
+        self.running = False
+        self.queue.put(None)
+
+    def command(self, line):
+        '''
+        Runs a line written to the control file, `warm PATH [GLOB...]` or
+        `pin PATH [GLOB...]` with PATH in the mount and !GLOB to skip files.
+        '''
+        words = shlex.split(line)
+        if len(words) < 2 or words[0] not in ('warm', 'pin') or not words[1].startswith('/'):
+            raise ValueError('usage: warm|pin /path [glob ...]')
+        self.submit(self.oxfs.remotepath(words[1]), words[2:], 'pin' == words[0])
+
+    def submit(self, root, patterns=(), pin=False):
+        root = os.path.normpath(root)
+        with self.lock:
+            self.trees[root] = dict(patterns=list(patterns), pin=pin, state='queued',
+                                    dirs=0, files=0, bytes=0, fetched=0)
+        if pin:
+            self.oxfs.manager.pin(root)
+        self.queue.put((root, root))
+
+    def changed(self, path):
+        # a listing of a pinned tree changed, walk it again
+        with self.lock:
+            roots = [root for root in self.trees if self.trees[root]['pin'] and
+                     (path == root or path.startswith(root.rstrip('/') + '/'))]
+        if roots:
+            self.queue.put((roots[0], path))
+
+    def status(self):
+        with self.lock:
+            return dict((root, dict(tree)) for root, tree in self.trees.items())
+
+    def update(self, root, **kwargs):
+        with self.lock:
+            self.trees[root].update(kwargs)
+
+    def loop(self):
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix='warm-up')
+        while self.running:
+            item = self.queue.get()
+            if item is None:
+                break
+            root, path = item
+            try:
+                self.warm(root, path)
+            except Exception as e:
+                self.logger.error('warm up {} failed, {}'.format(path, e))
+                self.update(root, state='failed')
+        self.executor.shutdown()
+
+    def warm(self, root, path):
+        tree = self.status()[root]
+        self.update(root, state='walking')
+        files = self.walk(root, path, tree['patterns'])
+        # small files first, a build or a grep opens many of them
+        files.sort()
+        budget, selected = self.oxfs.manager.maxsize, []
+        for size, child in files:
+            if size > self.oxfs.manager.syncsize or size > budget:
+                continue
+            budget -= size
+            selected.append(child)
+        self.update(root, state='fetching', files=tree['files'] + len(selected),
+                    bytes=tree['bytes'] + self.oxfs.manager.maxsize - budget)
+        task = functools.partial(self.oxfs.background, self.fetch, root)
+        list(self.executor.map(task, selected))
+        self.update(root, state='done' if self.running else 'stopped')
+        self.logger.info('warmed {} files of {}'.format(len(selected), path))
+
+    def walk(self, root, path, patterns):
+        '''
+        Returns [(size, path)] of the regular files below `path` to fetch.
+        '''
+        files, level = [], [path]
+        task = functools.partial(self.oxfs.background, self.listdir)
+        while level and self.running:
+            self.update(root, dirs=self.status()[root]['dirs'] + len(level))
+            subdirs = []
+            for directory, entries in zip(level, self.executor.map(task, level)):
+                for name in entries:
+                    child = os.path.join(directory, name)
+                    attr = self.oxfs.attributes.peek(child)
+                    if type(attr) != dict:
+                        continue
+                    if stat.S_ISDIR(attr['st_mode']):
+                        subdirs.append(child)
+                    elif stat.S_ISREG(attr['st_mode']) and \
+                            self.match(os.path.relpath(child, root), patterns):
+                        files.append((attr['st_size'], child))
+            level = subdirs
+        return files
+
+    @staticmethod
+    def match(path, patterns):
+        included = [p for p in patterns if not p.startswith('!')]
+        name = os.path.basename(path)
+        for pattern in patterns:
+            if pattern.startswith('!') and (fnmatch.fnmatch(path, pattern[1:]) or
+                                            fnmatch.fnmatch(name, pattern[1:])):
+                return False
+        return not included or any(fnmatch.fnmatch(path, p) or fnmatch.fnmatch(name, p)
+                                   for p in included)
+
+    def listdir(self, path):
+        try:
+            return self.oxfs.listdir(self.oxfs.channel(), path)
+        except (IOError, OSError) as e:
+            self.logger.debug('warm up {}, {}'.format(path, e))
+            return []
+
+    def fetch(self, root, path):
+        if not self.running:
+            return
+        try:
+            self.oxfs._getfile(path)
+        except Exception as e:
+            self.logger.debug('warm up {}, {}'.format(path, e))
+            return
+        with self.lock:
+            self.trees[root]['fetched'] += 1
+
+
+def mountroot(path):
+    # the closest directory holding the control directory of a mount
+    while True:
+        if os.path.isfile(os.path.join(path, CONTROL[1:], 'warmup')):
+            return path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='oxfs warmup', description='cache directory trees of a running oxfs mount')
+    parser.add_argument('paths', nargs='*', metavar='PATH',
+                        help='directories in an oxfs mount, the current one by default')
+    parser.add_argument('--pin', dest='pin', action='store_true',
+                        help='never evict them and keep them fresh, needs --auto-cache')
+    parser.add_argument('--include', dest='patterns', action='append', default=[],
+                        help='glob of the files to download, !glob to skip, may be repeated (default: all)')
+    parser.add_argument('--status', dest='status', action='store_true',
+                        help='print the progress of the warm ups')
+    args = parser.parse_args(argv)
+
+    for path in args.paths or ['.']:
+        path = os.path.abspath(path)
+        root = mountroot(path)
+        if root is None:
+            parser.error('{} is not in an oxfs mount'.format(path))
+        control = os.path.join(root, CONTROL[1:], 'warmup')
+        if args.status:
+            with open(control, 'r') as infile:
+                json.dump(json.load(infile), sys.stdout, indent=2)
+            sys.stdout.write('\n')
+            continue
+        relative = os.path.relpath(path, root)
+        words = ['pin' if args.pin else 'warm', '/' if '.' == relative else '/' + relative]
+        with open(control, 'w') as outfile:
+            outfile.write(' '.join(shlex.quote(word) for word in words + args.patterns) + '\n')
+
+
+if __name__ == '__main__':
+    main()
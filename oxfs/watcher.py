@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+import logging
+import os
+import shlex
+import threading
+import time
+
+REMOTE_WATCHER = r'''
+import ctypes, os, re, struct, sys
+libc = ctypes.CDLL(None, use_errno=True)
+fd = libc.inotify_init()
+if fd < 0:
+    sys.exit(1)
+# modify, attrib, close_write, moved_from, moved_to, create, delete,
+# delete_self, move_self
+MASK = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400 | 0x800
+EVENTS = ((0x2 | 0x8, 'modify'), (0x4, 'attrib'), (0x100, 'create'),
+          (0x200 | 0x400, 'delete'), (0x40 | 0x80 | 0x800, 'move'))
+# kernel views with no file changes to follow, never walked
+PSEUDO = {'autofs', 'binfmt_misc', 'bpf', 'cgroup', 'cgroup2', 'configfs', 'debugfs',
+          'devpts', 'devtmpfs', 'efivarfs', 'fusectl', 'hugetlbfs', 'mqueue', 'nsfs',
+          'proc', 'pstore', 'rpc_pipefs', 'securityfs', 'selinuxfs', 'sysfs', 'tracefs'}
+skip = set()
+try:
+    for line in open('/proc/self/mounts'):
+        fields = line.split()
+        if fields[2] in PSEUDO:
+            skip.add(re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), fields[1]))
+except OSError:
+    pass
+dirs = {}
+def watch(top):
+    for root, subdirs, _ in os.walk(top):
+        subdirs[:] = [d for d in subdirs if os.path.join(root, d) not in skip]
+        wd = libc.inotify_add_watch(fd, os.fsencode(root), MASK)
+        if wd >= 0:
+            dirs[wd] = root
+        else:
+            # past max_user_watches, its changes would go unseen
+            print('unwatched', root, flush=True)
+watch(sys.argv[1])
+print('READY', flush=True)
+while True:
+    buf = os.read(fd, 65536)
+    i = 0
+    while i < len(buf):
+        wd, mask, _, n = struct.unpack_from('iIII', buf, i)
+        name = os.fsdecode(buf[i + 16:i + 16 + n].rstrip(b'\0'))
+        i += 16 + n
+        if mask & 0x4000:
+            # the queue overflowed, events were lost
+            print('overflow', sys.argv[1], flush=True)
+            continue
+        if mask & 0x8000:
+            dirs.pop(wd, None)
+        root = dirs.get(wd)
+        if root is None:
+            continue
+        path = os.path.join(root, name) if name else root
+        if mask & 0x40000000 and mask & (0x80 | 0x100):
+            watch(path)
+        for bits, event in EVENTS:
+            if mask & bits:
+                print(event, path, flush=True)
+'''
+
+WATCH_COMMAND = 'python3 -c ' + shlex.quote(REMOTE_WATCHER) + ' {path}'
+
+
+class Watcher:
+    '''
+    Invalidates cached entries from a stream of remote change events, one
+    `event path` line each (modify, attrib, create, delete, move). The
+    command runs over ssh and prints READY once it watches `{path}`. While
+    it runs cached metadata does not expire, once it stops everything
+    cached is revalidated on next use. A directory it can not watch
+    (`unwatched path`) brings the lifetimes back for good, lost events
+    (`overflow path`) expire what is cached.
+    '''
+
+    def __init__(self, oxfs, command=None):
+        self.logger = logging.getLogger(__class__.__name__)
+        self.oxfs = oxfs
+        self.command = command or WATCH_COMMAND
+        self.active = False
+        self.covered = True  # every directory is watched
+        self.channel = None
+        self.running = True
+
+    def run(self):
+        self.thread = threading.Thread(target=self.loop, args=())
+        self.thread.daemon = True
+        self.thread.name = 'watcher'
+        self.thread.start()
+
+    def shutdown(self):
+        self.running = False
+        if self.channel is not None:
+            self.channel.close()
+
+    def loop(self):
+        backoff = 1
+        while self.running:
+            # a fresh lease on every start, a dead connection is replaced
+            ready = False
+            try:
+                self.sftp = self.oxfs.channel()
+                self.client = self.oxfs.pool.client(self.sftp)
+                ready = self.stream()
+            except Exception as e:
+                self.logger.debug(e)
+            finally:
+                self.oxfs.release_channel()
+            if not self.running:
+                break
+            if not ready:
+                self.logger.warning('remote watcher unavailable, falling back to polling')
+                break
+            self.logger.warning('remote watcher stopped, restart in {}s'.format(backoff))
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+
+    def stream(self):
+        '''
+        Follows the watcher until it exits, returns False if it never got
+        ready.
+        '''
+        command = self.command.replace('{path}', shlex.quote(self.oxfs.remote_path))
+        stdin, stdout, stderr = self.client.exec_command(command)
+        self.channel = stdout.channel
+        self.covered = True
+        ready = False
+        try:
+            events = dict()
+            for line in stdout:
+                event, _, path = line.rstrip('\n').partition(' ')
+                if 'unwatched' == event:
+                    self.unwatched(path)
+                    continue
+                if 'overflow' == event:
+                    self.logger.warning('remote watcher lost events, expiring the cache')
+                    self.expire()
+                    continue
+                if not ready:
+                    ready = 'READY' == event
+                    self.active = ready and self.covered
+                    continue
+                events.setdefault(os.path.normpath(path), set()).add(event)
+                # handle a burst of events once, each path at most once
+                if not self.channel.recv_ready():
+                    self.handle(events)
+                    events = dict()
+            self.handle(events)
+        finally:
+            if self.active:
+                self.active = False
+                self.expire()
+            stdin.close(), stdout.close(), stderr.close()
+        return ready
+
+    def unwatched(self, path):
+        # entries cached without a lifetime would never be refreshed
+        if self.covered:
+            self.logger.warning('{} is not watched, cached metadata expires again'.format(path))
+        self.covered = False
+        if self.active:
+            self.active = False
+            self.expire()
+
+    def expire(self):
+        self.oxfs.attributes.expire()
+        self.oxfs.directories.expire()
+
+    def handle(self, events):
+        for path, kinds in events.items():
+            self.logger.debug('{} {}'.format(path, sorted(kinds)))
+            self.invalidate(path, kinds)
+
+    def invalidate(self, path, kinds):
+        oxfs = self.oxfs
+        oxfs.attributes.remove(path)
+        if kinds & {'create', 'delete', 'move'}:
+            oxfs.directories.remove(os.path.dirname(path))
+        if kinds & {'delete', 'move'}:
+            # a moved directory takes everything cached below it along
+            oxfs.attributes.expire(path)
+            oxfs.directories.expire(path)
+            self.drop(path)
+        elif 'modify' in kinds:
+            self.revalidate(path)
+
+    def revalidate(self, path):
+        journal = self.oxfs.writeback.journal(path)
+        if journal is not None and (journal.size or journal.flushing.locked()):
+            # our own write, the flush keeps the cache file in step
+            return
+        manager = self.oxfs.manager
+        cachefile = manager.cachefile(path)
+        try:
+            st = self.sftp.lstat(path)
+            if manager.validator(cachefile) == [st.st_mtime, st.st_size]:
+                return
+        except Exception as e:
+            self.logger.debug(e)
+        self.drop(path)
+
+    def drop(self, path):
+        if self.oxfs.writeback.dirty(path):
+            return
+        self.oxfs.mtx.lock(path)
+        self.oxfs.manager.pop(self.oxfs.manager.cachefile(path))
+        self.oxfs.mtx.unlock(path)
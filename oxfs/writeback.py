@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+import bisect
+import logging
+import threading
+import time
+
+
+class Journal:
+    '''
+    Dirty ranges of one file, overlapping and adjacent writes are merged into
+    a single extent, sorted by offset. The bytes taken by a flush stay
+    `inflight` until it is done, the remote lags behind until then.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flushing = threading.Lock()  # keeps flushes of a file in order
+        self.starts = []
+        self.ends = []
+        self.buffers = []
+        self.size = 0
+        self.inflight = 0
+        self.queued = False
+
+    def add(self, offset, data, newer=True):
+        end = offset + len(data)
+        with self.lock:
+            i = bisect.bisect_left(self.ends, offset)
+            j = bisect.bisect_right(self.starts, end)
+            start = min([offset] + self.starts[i:j])
+            buf = bytearray(max([end] + self.ends[i:j]) - start)
+            if not newer:
+                buf[offset - start:end - start] = data
+            for s, b in zip(self.starts[i:j], self.buffers[i:j]):
+                buf[s - start:s - start + len(b)] = b
+                self.size -= len(b)
+            if newer:
+                buf[offset - start:end - start] = data
+            self.starts[i:j] = [start]
+            self.ends[i:j] = [start + len(buf)]
+            self.buffers[i:j] = [buf]
+            self.size += len(buf)
+
+    def take(self):
+        with self.lock:
+            extents = list(zip(self.starts, self.buffers))
+            self.starts, self.ends, self.buffers = [], [], []
+            self.inflight, self.size = self.size, 0
+            self.queued = False
+            return extents
+
+    def done(self):
+        with self.lock:
+            self.inflight = 0
+
+    def restore(self, extents):
+        # put back a failed flush without hiding the writes made since
+        for start, data in extents:
+            self.add(start, data, False)
+        self.done()
+
+
+class WriteBack:
+    '''
+    Per file write-back journals, flushed in order by `flush(path)` on a
+    timer, on demand, or once a file holds more than `max_dirty_kb`.
+    '''
+
+    def __init__(self, flush, interval=1, max_dirty_kb=2**12):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.flush = flush
+        self.interval = interval
+        self.maxdirty = max_dirty_kb << 10
+        self.journals = dict()
+        self.lock = threading.Lock()
+        self.running = True
+
+    def journal(self, path):
+        with self.lock:
+            return self.journals.get(path)
+
+    def write(self, path, offset, data):
+        '''
+        Returns True if the file should be flushed now.
+        '''
+        with self.lock:
+            journal = self.journals.get(path)
+            if journal is None:
+                journal = Journal()
+                self.journals[path] = journal
+            journal.add(offset, data)
+            return journal.size >= self.maxdirty and self.enqueue(journal)
+
+    def enqueue(self, journal):
+        with journal.lock:
+            if journal.queued or not journal.size:
+                return False
+            journal.queued = True
+            return True
+
+    def dirty(self, path=None):
+        with self.lock:
+            if path is not None:
+                journal = self.journals.get(path)
+                return journal.size + journal.inflight if journal is not None else 0
+            return sum(journal.size + journal.inflight for journal in self.journals.values())
+
+    def discard(self, path):
+        with self.lock:
+            journal = self.journals.pop(path, None)
+        if journal is not None:
+            journal.take()
+
+    def below(self, prefix):
+        # paths with a journal at or below `prefix`
+        with self.lock:
+            return [path for path in self.journals
+                    if path == prefix or path.startswith(prefix.rstrip('/') + '/')]
+
+    def pending(self):
+        with self.lock:
+            journals = list(self.journals.items())
+        return [path for path, journal in journals if self.enqueue(journal)]
+
+    def run(self, submit):
+        self.submit = submit
+        self.thread = threading.Thread(target=self.loop, args=())
+        self.thread.daemon = True
+        self.thread.name = 'write-back'
+        self.thread.start()
+
+    def shutdown(self):
+        self.running = False
+
+    def loop(self):
+        while self.running:
+            time.sleep(self.interval)
+            paths = self.pending()
+            if paths:
+                self.logger.info('flush {} files, {} dirty bytes'.format(
+                    len(paths), self.dirty()))
+            for path in paths:
+                self.submit(self.flush, path)
@@ -35,6 +35,9 @@ setup(
         'paramiko >= 2.0.0',
         'xxhash >= 1.3.0',
     ],
+    extras_require = {
+        'compress': ['lz4', 'zstandard'],
+    },
 
     entry_points={
         'console_scripts':[